@@ -0,0 +1,60 @@
+from dotenv import load_dotenv
+load_dotenv()
+
+import os
+import pymongo
+from typing import Optional
+from fastapi import FastAPI, Query
+
+from src.category_cache import normalize_name
+from src.accounts import DEFAULT_ACCOUNT
+
+MONGO_DB_URL = os.getenv('MONGO_DB_URL', None)
+
+client = pymongo.MongoClient(f"mongodb://{MONGO_DB_URL}")
+database = client["invoice"]
+
+app = FastAPI(title="E-Invoice Spending Analytics")
+
+
+def month_range(start: Optional[str], end: Optional[str]) -> dict:
+    months = {}
+    if start:
+        months["$gte"] = start
+    if end:
+        months["$lte"] = end
+    return {"month": months} if months else {}
+
+
+@app.get("/spending/monthly")
+def monthly_spending(start: Optional[str] = Query(None, description="first month, YYYY-MM"), end: Optional[str] = Query(None, description="last month, YYYY-MM"), account: str = DEFAULT_ACCOUNT):
+    """Monthly totals per AI category."""
+    cursor = database["rollup_category"].find({"account": account, **month_range(start, end)}, {"_id": 0, "account": 0}).sort([("month", 1), ("total", -1)])
+    return list(cursor)
+
+
+@app.get("/sellers/top")
+def top_sellers(start: Optional[str] = None, end: Optional[str] = None, limit: int = Query(10, ge=1, le=100), account: str = DEFAULT_ACCOUNT):
+    """Sellers with the highest spending over the given months."""
+    pipeline = [
+        {"$match": {"account": account, **month_range(start, end)}},
+        {"$group": {"_id": "$seller", "total": {"$sum": "$total"}, "invoices": {"$sum": "$invoices"}}},
+        {"$sort": {"total": -1}},
+        {"$limit": limit},
+        {"$project": {"_id": 0, "seller": "$_id", "total": 1, "invoices": 1}},
+    ]
+    return list(database["rollup_seller"].aggregate(pipeline))
+
+
+@app.get("/items/trend")
+def item_trend(item: str, start: Optional[str] = None, end: Optional[str] = None, account: str = DEFAULT_ACCOUNT):
+    """Monthly spending, quantity and purchase count for one item."""
+    cursor = database["rollup_item"].find({"account": account, "item": normalize_name(item), **month_range(start, end)}, {"_id": 0, "account": 0}).sort("month", 1)
+    return list(cursor)
+
+
+@app.get("/ai/usage")
+def ai_usage(start: Optional[str] = None, end: Optional[str] = None, account: str = DEFAULT_ACCOUNT):
+    """Monthly OpenAI calls, tokens, latency and estimated cost in USD, per task (categorize, describe)."""
+    cursor = database["rollup_ai"].find({"account": account, **month_range(start, end)}, {"_id": 0, "account": 0}).sort([("month", 1), ("task", 1)])
+    return list(cursor)
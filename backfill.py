@@ -0,0 +1,17 @@
+import argparse
+from datetime import datetime
+from manager import InvoiceManager
+from src.accounts import get_account
+
+parser = argparse.ArgumentParser(description="Backfill invoices for an arbitrary date range")
+parser.add_argument("start", type=lambda value: datetime.strptime(value, "%Y-%m-%d"), help="first day, YYYY-MM-DD")
+parser.add_argument("end", type=lambda value: datetime.strptime(value, "%Y-%m-%d").replace(hour=23, minute=59, second=59, microsecond=999999), help="last day (inclusive), YYYY-MM-DD")
+parser.add_argument("--granularity", choices=["month", "week"], default="month")
+parser.add_argument("--workers", type=int, default=2)
+parser.add_argument("--account", help="account to backfill, the first registered account when omitted")
+args = parser.parse_args()
+
+invoice_manager = InvoiceManager(get_account(args.account))
+
+invoice_manager.backfill(args.start, args.end, args.granularity, args.workers)
+invoice_manager.close()
@@ -0,0 +1,150 @@
+"""End-to-end benchmark of InvoiceManager.fetch_once against local fake services.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_fetch --sizes 10 1000 10000
+
+Results are written to benchmarks/results/ and compared with the previous run.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from pathlib import Path
+from datetime import datetime
+
+from benchmarks.fake_services import (
+    EinvoiceConfig, OpenAIConfig, TelegramConfig,
+    EinvoiceHandler, OpenAIHandler, TelegramHandler,
+    serve, url_of,
+)
+
+RESULTS_DIR = Path(__file__).parent / 'results'
+REGRESSION_THRESHOLD = 0.2
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000], help='invoice counts to benchmark')
+    parser.add_argument('--items', type=int, default=5, help='line items per invoice')
+    parser.add_argument('--portal-latency', type=float, default=0.05)
+    parser.add_argument('--openai-latency', type=float, default=0.3)
+    parser.add_argument('--telegram-latency', type=float, default=0.05)
+    parser.add_argument('--max-rps', type=float, default=200, help='EINVOICE_MAX_RPS for the run')
+    parser.add_argument('--mongo-url', default=None, help='host:port of a local MongoDB, mongomock is used when omitted')
+    return parser.parse_args()
+
+
+def configure_environment(args, portal_url: str, openai_url: str, telegram_url: str, workdir: str) -> None:
+    """Point every external dependency at the fakes; must run before `manager` is imported."""
+    session_path = os.path.join(workdir, 'session.json')
+    os.environ.update({
+        'EINVOICE_PHONE': 'benchmark',
+        'EINVOICE_PASSWORD': 'benchmark',
+        'EINVOICE_API_BASE': portal_url,
+        'EINVOICE_SESSION_PATH': session_path,
+        'EINVOICE_MAX_RPS': str(args.max_rps),
+        'OPENAI_API_KEY': 'benchmark',
+        'OPENAI_ENDPOINT': f'{openai_url}/v1',
+        'TELEGRAM_BOT_API': 'benchmark',
+        'TELEGRAM_CHAT_ID': '1',
+        'TELEGRAM_API_BASE': f'{telegram_url}/bot',
+        'TELEGRAM_DIGEST_WINDOW': '1',
+        'CLASSIFIER_PATH': os.path.join(workdir, 'no-classifier.joblib'),
+        'MONGO_DB_URL': args.mongo_url or 'mongomock',
+        'METRICS_PORT': '0',
+    })
+    from src.accounts import DEFAULT_ACCOUNT
+    from src.session_store import account_session_path
+    with open(account_session_path(DEFAULT_ACCOUNT), 'w') as f:
+        json.dump({'expires_at': time.time() + 86400, 'headers': {'authorization': 'Bearer fake', 'content-type': 'application/json'}, 'cookies': []}, f)
+    if not args.mongo_url:
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+
+
+def run_size(size: int, einvoice_config: EinvoiceConfig) -> dict:
+    import pymongo
+    from manager import InvoiceManager, MONGO_DB_URL
+    from src.metrics import metrics
+    from src.accounts import DEFAULT_ACCOUNT
+
+    einvoice_config.invoices = size
+    client = pymongo.MongoClient(f"mongodb://{MONGO_DB_URL}")
+    client.drop_database('invoice')
+    # Measure the regular incremental sync, not the monthly catch-up of the previous month
+    client['invoice']['sync_state'].insert_one({'_id': DEFAULT_ACCOUNT, 'caught_up_month': '9999-12'})
+    metrics.reset()
+    # mongomock clients do not share storage, so the manager must use the client seeded above
+    invoice_manager = InvoiceManager(client=client)
+
+    start = time.perf_counter()
+    invoice_manager.fetch_once()
+    elapsed = time.perf_counter() - start
+
+    stored = invoice_manager.db.count_documents({})
+    # Only the sync is timed; drain background descriptions and edits so they cannot leak into the next size
+    drain_start = time.perf_counter()
+    invoice_manager.close()
+    drain = time.perf_counter() - drain_start
+    snapshot = metrics.snapshot()
+    return {
+        'invoices': size,
+        'stored': stored,
+        'seconds': round(elapsed, 3),
+        'drain_seconds': round(drain, 3),
+        'invoices_per_second': round(stored / elapsed, 2) if elapsed else 0.0,
+        'stages': snapshot['stages'],
+        'counters': snapshot['counters'],
+    }
+
+
+def compare(previous: dict, current: dict) -> list:
+    regressions = []
+    for size, result in current['runs'].items():
+        before = previous.get('runs', {}).get(size)
+        if not before or not before['invoices_per_second']:
+            continue
+        change = result['invoices_per_second'] / before['invoices_per_second'] - 1
+        if change < -REGRESSION_THRESHOLD:
+            regressions.append(f"{size} invoices: {before['invoices_per_second']} -> {result['invoices_per_second']} invoices/s ({change:+.0%})")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    einvoice_config = EinvoiceConfig(items_per_invoice=args.items, latency=args.portal_latency)
+    servers = [
+        serve(EinvoiceHandler, einvoice_config),
+        serve(OpenAIHandler, OpenAIConfig(latency=args.openai_latency)),
+        serve(TelegramHandler, TelegramConfig(latency=args.telegram_latency)),
+    ]
+    workdir = tempfile.mkdtemp(prefix='einvoice-bench-')
+    configure_environment(args, *(url_of(server) for server in servers), workdir)
+    os.chdir(workdir)
+
+    result = {'timestamp': datetime.now().isoformat(timespec='seconds'), 'args': vars(args), 'runs': {}}
+    for size in args.sizes:
+        run = run_size(size, einvoice_config)
+        result['runs'][str(size)] = run
+        print(f"{size:>6} invoices: {run['seconds']:>8.2f} s, {run['invoices_per_second']:>8.2f} invoices/s, {run['drain_seconds']:>8.2f} s to drain descriptions", file=sys.stderr)
+
+    RESULTS_DIR.mkdir(exist_ok=True)
+    previous_runs = sorted(RESULTS_DIR.glob('fetch-*.json'))
+    output = RESULTS_DIR / f"fetch-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    output.write_text(json.dumps(result, indent=2))
+    print(f'Results saved to {output}', file=sys.stderr)
+
+    if previous_runs:
+        regressions = compare(json.loads(previous_runs[-1].read_text()), result)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Cold-start benchmark: import time, memory and heavy dependencies loaded by each entry module.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_startup --runs 5
+
+Every import happens in a fresh interpreter. Results are written to benchmarks/results/ and
+compared with the previous run; a slower import or a newly loaded heavy dependency fails it.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+from datetime import datetime
+
+RESULTS_DIR = Path(__file__).parent / 'results'
+REPO_ROOT = Path(__file__).parent.parent
+REGRESSION_THRESHOLD = 0.2
+ENTRY_MODULES = ['manager', 'src.export', 'src.crawl_tools', 'api']
+# Only the code paths that need them may import these
+HEAVY_MODULES = ['ddddocr', 'onnxruntime', 'selenium', 'openai', 'telegram', 'sklearn', 'pandas', 'pyarrow']
+
+PROBE = """
+import sys, json, time, resource
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    'seconds': seconds,
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'heavy_modules': [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+
+def measure(module: str, runs: int) -> dict:
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            cwd=REPO_ROOT, env={**os.environ, 'METRICS_PORT': '0'}, capture_output=True, text=True, check=True,
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        'seconds': round(statistics.median(sample['seconds'] for sample in samples), 4),
+        'max_rss_mb': round(max(sample['max_rss_kb'] for sample in samples) / 1024, 1),
+        'heavy_modules': samples[-1]['heavy_modules'],
+    }
+
+
+def compare(previous: dict, current: dict) -> list:
+    regressions = []
+    for module, result in current['modules'].items():
+        before = previous.get('modules', {}).get(module)
+        if not before:
+            continue
+        if before['seconds'] and result['seconds'] / before['seconds'] - 1 > REGRESSION_THRESHOLD:
+            regressions.append(f"import {module}: {before['seconds']} -> {result['seconds']} s")
+        added = sorted(set(result['heavy_modules']) - set(before['heavy_modules']))
+        if added:
+            regressions.append(f"import {module} now loads {', '.join(added)}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per module, the median is reported')
+    parser.add_argument('--modules', nargs='+', default=ENTRY_MODULES)
+    args = parser.parse_args()
+
+    result = {'timestamp': datetime.now().isoformat(timespec='seconds'), 'python': sys.version.split()[0], 'modules': {}}
+    for module in args.modules:
+        result['modules'][module] = run = measure(module, args.runs)
+        print(f"{module:<18} {run['seconds']:>7.3f} s {run['max_rss_mb']:>8.1f} MB  heavy: {', '.join(run['heavy_modules']) or '-'}", file=sys.stderr)
+
+    RESULTS_DIR.mkdir(exist_ok=True)
+    previous_runs = sorted(RESULTS_DIR.glob('startup-*.json'))
+    output = RESULTS_DIR / f"startup-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    output.write_text(json.dumps(result, indent=2))
+    print(f'Results saved to {output}', file=sys.stderr)
+
+    if previous_runs:
+        regressions = compare(json.loads(previous_runs[-1].read_text()), result)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
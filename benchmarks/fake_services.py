@@ -0,0 +1,146 @@
+"""Local stand-ins for the e-invoice portal, OpenAI and Telegram used by the benchmarks."""
+import json
+import time
+import random
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+@dataclass
+class EinvoiceConfig:
+    invoices: int = 10
+    items_per_invoice: int = 5
+    latency: float = 0.05
+
+
+@dataclass
+class OpenAIConfig:
+    latency: float = 0.3
+
+
+@dataclass
+class TelegramConfig:
+    latency: float = 0.05
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def _reply(self, status: int, body, content_type: str = 'application/json'):
+        data = body if isinstance(body, bytes) else (body.encode() if isinstance(body, str) else json.dumps(body, ensure_ascii=False).encode())
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_OPTIONS(self):
+        self._body()
+        self._reply(200, b'')
+
+
+class EinvoiceHandler(_Handler):
+    """Serves the btc502w listing, getCarrierInvoiceDetail and getCarrierInvoiceData endpoints."""
+
+    def do_POST(self):
+        body = self._body()
+        time.sleep(self.config.latency)
+        url = urlparse(self.path)
+        endpoint = url.path.rsplit('/', 1)[-1]
+        if endpoint == 'getSearchCarrierInvoiceListJWT':
+            self._reply(200, 'fake-jwt', 'text/plain')
+        elif endpoint == 'searchCarrierInvoice':
+            query = parse_qs(url.query)
+            size = int(query.get('size', ['100'])[0])
+            page = int(query.get('page', ['0'])[0])
+            total_pages = max(1, -(-self.config.invoices // size))
+            start = page * size
+            content = [self._listing(index) for index in range(start, min(start + size, self.config.invoices))]
+            self._reply(200, {'content': content, 'totalPages': total_pages, 'number': page})
+        elif endpoint == 'getCarrierInvoiceDetail':
+            index = int(json.loads(body).rsplit('-', 1)[-1])
+            self._reply(200, {'content': [self._item(index, n) for n in range(self.config.items_per_invoice)]})
+        elif endpoint == 'getCarrierInvoiceData':
+            index = int(json.loads(body).rsplit('-', 1)[-1])
+            issued = datetime.now().replace(day=1, hour=index % 24, minute=index % 60, second=0)
+            self._reply(200, {'invoiceDate': issued.strftime('%Y%m%d'), 'invoiceTime': issued.strftime('%H:%M:%S')})
+        else:
+            self._reply(404, {'error': endpoint})
+
+    def _listing(self, index: int) -> dict:
+        return {
+            'invoiceNumber': f'BM{index:08d}',
+            'token': f'token-{index}',
+            'totalAmount': str(self.config.items_per_invoice * 45),
+            'sellerName': f'Seller {index % 50}',
+            'invoiceDate': datetime.now().strftime('%Y%m%d'),
+        }
+
+    @staticmethod
+    def _item(index: int, n: int) -> dict:
+        return {'item': f'Item {(index * 7 + n) % 500}', 'quantity': '1', 'unitPrice': '45', 'amount': '45'}
+
+
+class OpenAIHandler(_Handler):
+    """Answers /chat/completions; JSON-mode requests get one category per record in the trailing JSON array."""
+
+    def do_POST(self):
+        request = json.loads(self._body())
+        time.sleep(self.config.latency)
+        prompt = request['messages'][-1]['content']
+        if request.get('response_format', {}).get('type') == 'json_object':
+            records = json.loads(prompt.rsplit('\n', 1)[-1])
+            content = json.dumps({'categories': [random.choice(['Dining', 'Groceries', 'Shopping']) for _ in records]})
+        else:
+            content = 'Groceries'
+        usage = {'prompt_tokens': len(prompt) // 2, 'completion_tokens': len(content) // 2}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        self._reply(200, {
+            'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': int(time.time()), 'model': request['model'],
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': usage,
+        })
+
+
+class TelegramHandler(_Handler):
+    """Implements the getMe and sendMessage Bot API calls."""
+    message_id = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self._body()
+        time.sleep(self.config.latency)
+        method = urlparse(self.path).path.rsplit('/', 1)[-1]
+        if method == 'getMe':
+            self._reply(200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}})
+        elif method in ('sendMessage', 'editMessageText'):
+            with TelegramHandler.lock:
+                TelegramHandler.message_id += 1
+                message_id = TelegramHandler.message_id
+            self._reply(200, {'ok': True, 'result': {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': 1, 'type': 'private'}, 'text': ''}})
+        else:
+            self._reply(200, {'ok': True, 'result': True})
+
+
+def serve(handler, config) -> ThreadingHTTPServer:
+    """Start `handler` on a free local port in a daemon thread, sharing the mutable `config`."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), type(handler.__name__, (handler,), {'config': config}))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def url_of(server: ThreadingHTTPServer) -> str:
+    host, port = server.server_address[:2]
+    return f'http://{host}:{port}'
@@ -0,0 +1,23 @@
+from dotenv import load_dotenv
+load_dotenv()
+
+import os
+import argparse
+import pymongo
+from datetime import datetime
+from src.export import EXPORTERS, iter_invoices
+from src.accounts import DEFAULT_ACCOUNT
+
+MONGO_DB_URL = os.getenv('MONGO_DB_URL', None)
+
+parser = argparse.ArgumentParser(description="Export invoices in a date range to CSV/Parquet or Cashew import payloads")
+parser.add_argument("start", type=lambda value: datetime.strptime(value, "%Y-%m-%d"), help="first day, YYYY-MM-DD")
+parser.add_argument("end", type=lambda value: datetime.strptime(value, "%Y-%m-%d").replace(hour=23, minute=59, second=59), help="last day (inclusive), YYYY-MM-DD")
+parser.add_argument("--format", choices=sorted(EXPORTERS), default="csv")
+parser.add_argument("--output", required=True, help="output file (numbered per batch for cashew-json)")
+parser.add_argument("--account", default=DEFAULT_ACCOUNT)
+args = parser.parse_args()
+
+client = pymongo.MongoClient(f"mongodb://{MONGO_DB_URL}")
+
+EXPORTERS[args.format](iter_invoices(client["invoice"][args.account], args.start, args.end), args.output)
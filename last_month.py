@@ -1,5 +1,11 @@
-from manager import InvoiceManager
+import pymongo
+from manager import InvoiceManager, MONGO_DB_URL, load_categorizers
+from src.accounts import load_accounts
 
-invoice_manager = InvoiceManager()
+client = pymongo.MongoClient(f"mongodb://{MONGO_DB_URL}")
+category_cache, classifier = load_categorizers(client)
 
-invoice_manager.fetch_last_month()
\ No newline at end of file
+for account in load_accounts():
+    invoice_manager = InvoiceManager(account, client, category_cache, classifier)
+    invoice_manager.fetch_last_month()
+    invoice_manager.close()
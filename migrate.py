@@ -0,0 +1,19 @@
+from dotenv import load_dotenv
+load_dotenv()
+
+import os
+import pymongo
+from src.einvoice import migrate_invoices
+from src.rollups import ensure_indexes, rebuild_rollups
+from src.accounts import load_accounts
+from src.archive import RawArchive
+
+MONGO_DB_URL = os.getenv('MONGO_DB_URL', None)
+
+client = pymongo.MongoClient(f"mongodb://{MONGO_DB_URL}")
+for account in load_accounts():
+    collection = client["invoice"][account.name]
+    migrate_invoices(collection)
+    RawArchive(client["invoice"]["raw_responses"], account.name).adopt(collection)
+    ensure_indexes(client["invoice"], collection)
+    rebuild_rollups(client["invoice"], collection.name, collection)
@@ -0,0 +1,13 @@
+import argparse
+from manager import InvoiceManager
+from src.accounts import get_account
+
+parser = argparse.ArgumentParser(description="Rebuild invoices from the raw response archive and re-run AI")
+parser.add_argument("invoice_numbers", nargs="*", help="invoice numbers to reprocess, all archived invoices when omitted")
+parser.add_argument("--account", help="account whose invoices are rebuilt, the first registered account when omitted")
+args = parser.parse_args()
+
+invoice_manager = InvoiceManager(get_account(args.account))
+
+invoice_manager.reprocess(args.invoice_numbers or None)
+invoice_manager.close()
@@ -3,8 +3,11 @@ load_dotenv()
 
 import logging
 import structlog
-from manager import InvoiceManager
-from src.chrome import check_chrome_exists
+import pymongo
+from manager import InvoiceManager, MONGO_DB_URL, load_categorizers
+from src.accounts import load_accounts
+from src.scheduler import AccountScheduler
+from src.metrics import start_metrics_server, write_snapshot
 
 logging.basicConfig(
     level=logging.INFO,
@@ -28,31 +31,18 @@ structlog.configure(
 
 logger = structlog.get_logger()
 
-check_chrome_exists(force_redownload=False)
 
-import time
-import random
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
-from threading import Thread
-
-def run_at_first_day_of_month():
-    while True:
-        sleep_seconds = ((datetime.now().replace(day=1) + relativedelta(months=1)).replace(hour=8, minute=0, second=0, microsecond=0) - datetime.now()).total_seconds()
-        logger.info(f"Sleeping until the first day of next month: (about {sleep_seconds} seconds)")
-        time.sleep(sleep_seconds + 10)  # wait a bit more to ensure it's the next month
-        logger.info("It's the first day of the month, fetching last month's invoices")
-        invoice_manager.fetch_last_month()
+def poll(account: str) -> int:
+    new_invoices = invoice_managers[account].fetch_once()
+    write_snapshot()
+    return new_invoices
 
 
 if __name__ == "__main__":
     logger.info('Started invoice manager')
-    invoice_manager = InvoiceManager()
-    thread = Thread(target=run_at_first_day_of_month, daemon=True)
-    thread.start()
-    
-    while True:
-        invoice_manager.fetch_once()
-        sleep_time = random.randint(6000, 21600)
-        logger.info(f"Fetch complete, sleeping for {sleep_time} seconds")
-        time.sleep(sleep_time)
\ No newline at end of file
+    client = pymongo.MongoClient(f"mongodb://{MONGO_DB_URL}")
+    category_cache, classifier = load_categorizers(client)
+    invoice_managers = {account.name: InvoiceManager(account, client, category_cache, classifier) for account in load_accounts()}
+    start_metrics_server()
+
+    AccountScheduler(poll, {name: invoice_manager.poll_plan for name, invoice_manager in invoice_managers.items()}).run()
\ No newline at end of file
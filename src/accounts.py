@@ -0,0 +1,64 @@
+import os
+import re
+import json
+import structlog
+from dataclasses import dataclass
+from typing import List, Optional
+
+ACCOUNTS_PATH = os.getenv("EINVOICE_ACCOUNTS_PATH", "accounts.json")
+# Name (and invoice collection) of the account configured through EINVOICE_PHONE / EINVOICE_PASSWORD
+DEFAULT_ACCOUNT = os.getenv("EINVOICE_ACCOUNT", "lambert")
+# Collections of the invoice database shared by all accounts, so no account may be named after them
+RESERVED_NAMES = {"sync_state", "backfill_checkpoints", "raw_responses", "category_cache", "rollup_category", "rollup_seller", "rollup_item", "rollup_ai"}
+
+logger = structlog.get_logger()
+
+
+@dataclass(slots=True)
+class Account:
+    """One e-invoice carrier; its invoices live in the `invoice.<name>` collection."""
+    name: str
+    phone: str
+    password: str
+    telegram_chat_id: Optional[str] = None
+    max_rps: Optional[float] = None
+
+
+def _validate(accounts: List[Account]) -> List[Account]:
+    names = set()
+    for account in accounts:
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", account.name) or account.name in RESERVED_NAMES:
+            raise RuntimeError(f"Invalid account name: {account.name!r}")
+        if account.name in names:
+            raise RuntimeError(f"Duplicate account name: {account.name!r}")
+        names.add(account.name)
+    return accounts
+
+
+def load_accounts(path: str = ACCOUNTS_PATH) -> List[Account]:
+    """Read the account registry, a JSON list of Account fields.
+
+    Without a registry file the single account from EINVOICE_PHONE / EINVOICE_PASSWORD is
+    used, named DEFAULT_ACCOUNT. Accounts without a chat id notify TELEGRAM_CHAT_ID.
+    """
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            accounts = [Account(**{'telegram_chat_id': os.getenv("TELEGRAM_CHAT_ID"), **entry}) for entry in json.load(f)]
+        logger.info("Account registry loaded", path=path, accounts=[account.name for account in accounts])
+        return _validate(accounts)
+
+    phone, password = os.getenv("EINVOICE_PHONE"), os.getenv("EINVOICE_PASSWORD")
+    if phone is None or password is None:
+        raise RuntimeError(f"No account registry at {path}, and EINVOICE_PHONE and EINVOICE_PASSWORD environment variables are not set")
+    return _validate([Account(DEFAULT_ACCOUNT, phone, password, os.getenv("TELEGRAM_CHAT_ID"))])
+
+
+def get_account(name: Optional[str] = None, path: str = ACCOUNTS_PATH) -> Account:
+    """Look up one account by name; the first registered account when `name` is None."""
+    accounts = load_accounts(path)
+    if name is None:
+        return accounts[0]
+    for account in accounts:
+        if account.name == name:
+            return account
+    raise RuntimeError(f"Unknown account: {name}")
@@ -1,51 +1,287 @@
-from openai import OpenAI
+import re
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+from src.einvoice import Invoice, CATEGORY_SOURCE_LLM, CATEGORY_SOURCE_CACHE, CATEGORY_SOURCE_CLASSIFIER
+from src.category_cache import CategoryCache
+from src.classifier import CategoryClassifier
 
+categories = "Dining, Groceries, Shopping, Transit, Entertainment, Bills & Fees, Gifts, Beauty, Work, Travel"
+category_list = categories.split(", ")
 categorize_model = "gpt-5-mini-2025-08-07"
-categorize_prompt = """
-Give the categories: Dining, Groceries, Shopping, Transit, Entertainment, Bills & Fees, Gifts, Beauty, Work, Travel
-Which category should the following record be in? Reply only the raw category name, no other context allowed.
+categorize_prompt = f"""
+Give the categories: {categories}
+Which category should the following item be in? Reply only the raw category name, no other context allowed.
 """
+categorize_batch_prompt = f"""
+Give the categories: {categories}
+Which category should each item name in the following JSON array be in? Reply only a JSON object of the form {{"categories": [...]}} holding one raw category name per item, in the same order as the items.
+"""
+
+# Cached categories are only valid for the model/prompt that produced them
+categorize_version = hashlib.sha1(f"{categorize_model}|{categories}|{categorize_prompt}|{categorize_batch_prompt}".encode()).hexdigest()[:12]
 
 describe_model = "gpt-4o-2024-08-06"
 describe_character = "路邊的可愛高中妹妹"
 describe_prompt = f"""
-下面是一張發票明細，想像你是{describe_character}，請用{describe_character}的語氣並以一句話來評論這張發票。如果有需要，可以適當加上顏文字
+下面是一張發票明細（店家、時間、總金額，接著每行一個品項：品名 x數量 金額），想像你是{describe_character}，請用{describe_character}的語氣並以一句話來評論這張發票。如果有需要，可以適當加上顏文字
 """
 
 import os
 OPENAI_ENDPOINT = os.getenv("OPENAI_ENDPOINT", "https://api.openai.com/v1")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", None)
+# Seconds before any OpenAI request is abandoned, so a hung endpoint cannot stall a sync
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", 60))
+# Most OpenAI spend in USD one sync of one account may use, 0 for no cap
+AI_SYNC_BUDGET = float(os.getenv("AI_SYNC_BUDGET_USD", 0))
+# USD per million prompt and completion tokens, for the spend estimate; unlisted models count as free
+MODEL_PRICES = {
+    categorize_model: (0.25, 2.0),
+    describe_model: (2.5, 10.0),
+}
 
 import structlog
+from src.metrics import metrics, timed
 logger = structlog.get_logger()
 
-if OPENAI_API_KEY and OPENAI_ENDPOINT:
-    openai = OpenAI(
-        api_key=OPENAI_API_KEY,
-        base_url=OPENAI_ENDPOINT
-    )
+OPENAI_ENABLED = bool(OPENAI_API_KEY and OPENAI_ENDPOINT)
+_openai = None
+_openai_lock = threading.Lock()
+
+def get_openai():
+    """The OpenAI client, created on first use so importing this module stays cheap; None without an API key."""
+    global _openai
+    if not OPENAI_ENABLED:
+        return None
+    with _openai_lock:
+        if _openai is None:
+            from openai import OpenAI
+            _openai = OpenAI(
+                api_key=OPENAI_API_KEY,
+                base_url=OPENAI_ENDPOINT,
+                timeout=OPENAI_TIMEOUT,
+            )
+    return _openai
+
+CLASSIFIER_THRESHOLD = float(os.getenv("CLASSIFIER_THRESHOLD", 0.8))
+
+class AIBudgetExceeded(RuntimeError):
+    pass
+
+
+class SpendCap:
+    """OpenAI spend of one account's current sync, shared by all of its AI workers.
+
+    Once `limit_usd` is reached `ai` refuses further calls until `reset`; a call already
+    in flight still completes and is counted.
+    """
+
+    def __init__(self, limit_usd: float = AI_SYNC_BUDGET):
+        self.limit_usd = limit_usd
+        self.spent_usd = 0.0
+        self._lock = threading.Lock()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.spent_usd = 0.0
+
+    def add(self, cost_usd: float) -> None:
+        with self._lock:
+            self.spent_usd += cost_usd
+
+    @property
+    def exhausted(self) -> bool:
+        return self.limit_usd > 0 and self.spent_usd >= self.limit_usd
+
+
+_usage = threading.local()
+
+@contextmanager
+def track_usage():
+    """Collect the usage of every OpenAI call this thread makes inside the block, one dict per call."""
+    calls = []
+    stack = _usage.__dict__.setdefault('stack', [])
+    stack.append(calls)
+    try:
+        yield calls
+    finally:
+        stack.pop()
 
-else:
-    openai = None
+def usage_totals(calls: List[dict]) -> Dict[str, float]:
+    """Sum per-call usage into the counters stored on invoices and in the monthly AI rollup; empty without calls."""
+    if not calls:
+        return {}
+    totals = {"calls": len(calls), "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0, "cost_usd": 0.0}
+    for call in calls:
+        for key in ("prompt_tokens", "completion_tokens", "seconds", "cost_usd"):
+            totals[key] += call[key]
+    totals["seconds"] = round(totals["seconds"], 3)
+    totals["cost_usd"] = round(totals["cost_usd"], 6)
+    return totals
 
-def ai(model: str, prompt: str, invoice_item: str):
+def compact_items(invoice_items: List[dict]) -> str:
+    """Item names as a one-line JSON array; quantities, prices and the portal's other fields do not change the category."""
+    return json.dumps([item.get('item') for item in invoice_items], ensure_ascii=False, separators=(',', ':'))
 
+def compact_invoice(invoice: Invoice) -> str:
+    """Seller, time, total and one line per item, the fields the describe prompt refers to."""
+    lines = [invoice.seller_name, invoice.invoice_datetime.strftime('%Y-%m-%d %H:%M'), str(invoice.total_amount)]
+    lines += [f"{item.item_name} x{item.quantity} {item.total_price}" for item in invoice.items]
+    return "\n".join(lines)
+
+Categorized = Tuple[Optional[str], Optional[str]]
+_canonical_categories = {category.casefold(): category for category in category_list}
+
+def normalize_category(reply) -> Optional[str]:
+    """Map a model reply such as ' "dining." ' or 'Category: Dining' onto `category_list`; None when it names no listed category."""
+    if reply is None:
+        return None
+    text = re.sub(r'^\s*category\s*[:：]', '', str(reply), flags=re.IGNORECASE)
+    text = text.strip().strip('"\'`*.。,，!').strip()
+    return _canonical_categories.get(text.casefold())
+
+def _lookup_category(item_name: Optional[str], seller: Optional[str], cache: Optional[CategoryCache], classifier: Optional[CategoryClassifier], offline: bool = False) -> Categorized:
+    """Resolve a (category, source) pair locally (cache, then classifier) without calling OpenAI.
+
+    When `offline`, because OpenAI is disabled or the spend cap is reached, the classifier's
+    best guess is used whatever its confidence.
+    """
+    if not item_name:
+        return None, None
+    if cache is not None:
+        category = cache.get(item_name, seller)
+        if category is not None:
+            return category, CATEGORY_SOURCE_CACHE
+    if classifier is not None:
+        category, confidence = classifier.predict(item_name, seller)
+        # Without OpenAI the classifier's best guess beats no category at all
+        if confidence >= CLASSIFIER_THRESHOLD or offline or not OPENAI_ENABLED:
+            return category, CATEGORY_SOURCE_CLASSIFIER
+    return None, None
+
+def _record_usage(model: str, usage, seconds: float, cap: Optional[SpendCap]) -> dict:
+    prompt_tokens = getattr(usage, 'prompt_tokens', None) or 0
+    completion_tokens = getattr(usage, 'completion_tokens', None) or 0
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    call = {
+        "model": model,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "seconds": seconds,
+        "cost_usd": (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000,
+    }
+    metrics.incr('prompt_tokens', f"openai:{model}", prompt_tokens)
+    metrics.incr('completion_tokens', f"openai:{model}", completion_tokens)
+    if cap is not None:
+        cap.add(call["cost_usd"])
+    for calls in getattr(_usage, 'stack', []):
+        calls.append(call)
+    return call
+
+def ai(model: str, prompt: str, invoice_item: str, cap: Optional[SpendCap] = None, **kwargs):
+
+    openai = get_openai()
     if not openai:
         logger.warning('OpenAI API Key is not provided, AI function will not proceed')
         return
+    if cap is not None and cap.exhausted:
+        raise AIBudgetExceeded(f"AI spend cap of {cap.limit_usd} USD reached for this sync")
 
-    response = openai.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "user", "content": prompt + invoice_item}
-        ]
-    )
+    with timed(f"openai:{model}") as timer:
+        response = openai.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "user", "content": prompt + invoice_item}
+            ],
+            **kwargs
+        )
+    call = _record_usage(model, response.usage, timer.elapsed, cap)
+    logger.info('AI completion', model=model, duration=timer.elapsed, prompt_tokens=call["prompt_tokens"], completion_tokens=call["completion_tokens"], cost_usd=round(call["cost_usd"], 6))
     return response.choices[0].message.content
 
-def ai_categorize(invoice_item: str):
-    return ai(categorize_model, categorize_prompt, invoice_item)
+def ai_categorize(item_name: Optional[str], seller: Optional[str] = None, cap: Optional[SpendCap] = None,
+                  cache: Optional[CategoryCache] = None, classifier: Optional[CategoryClassifier] = None) -> Categorized:
+    offline = cap is not None and cap.exhausted
+    category, source = _lookup_category(item_name, seller, cache, classifier, offline)
+    if category is not None or offline or not item_name:
+        return category, source
+
+    try:
+        reply = ai(categorize_model, categorize_prompt, item_name, cap)
+    except Exception as e:
+        logger.warning('AI categorization failed, using the local classifier', item=item_name, error=str(e))
+        return _lookup_category(item_name, seller, cache, classifier, offline=True)
+    if reply is None:
+        return None, None
+    category = normalize_category(reply)
+    if category is None:
+        logger.warning('AI replied with an unknown category, using the local classifier', item=item_name, reply=reply)
+        return _lookup_category(item_name, seller, cache, classifier, offline=True)
+    if cache is not None:
+        cache.set(item_name, seller, category)
+    return category, CATEGORY_SOURCE_LLM
+
+def _categorize_items(invoice_items: List[dict], sellers: List[Optional[str]], cap: Optional[SpendCap] = None,
+                     cache: Optional[CategoryCache] = None, classifier: Optional[CategoryClassifier] = None) -> List[Categorized]:
+    offline = cap is not None and cap.exhausted
+    if offline:
+        logger.warning('AI spend cap reached, categorizing locally', items=len(invoice_items), spent_usd=round(cap.spent_usd, 4))
+    result = [_lookup_category(item.get('item'), seller, cache, classifier, offline) for item, seller in zip(invoice_items, sellers)]
+    pending = [i for i, (category, _) in enumerate(result) if category is None and not offline]
+    if not pending:
+        return result
+    if not OPENAI_ENABLED:
+        logger.warning('OpenAI API Key is not provided, AI function will not proceed')
+        return result
+
+    pending_items = [invoice_items[i] for i in pending]
+    try:
+        content = ai(categorize_model, categorize_batch_prompt, compact_items(pending_items), cap, response_format={"type": "json_object"})
+    except Exception as e:
+        # OpenAI down or timing out (or the spend cap hit mid-sync): keep the sync going on local guesses
+        logger.warning('Batch categorization failed, using the local classifier', error=str(e), items=len(pending_items))
+        for i in pending:
+            result[i] = _lookup_category(invoice_items[i].get('item'), sellers[i], cache, classifier, offline=True)
+        return result
+    try:
+        categories = json.loads(content)['categories']
+        if not isinstance(categories, list) or len(categories) != len(pending_items):
+            raise ValueError(f"expected {len(pending_items)} categories, got {categories!r}")
+    except (TypeError, ValueError, KeyError) as e:
+        logger.warning('Batch categorization reply could not be parsed, falling back to per-item calls', error=str(e), items=len(pending_items))
+        categories = [ai_categorize(invoice_items[i].get('item'), sellers[i], cap, cache, classifier) for i in pending]
+    else:
+        replies, categories = categories, []
+        for i, reply in zip(pending, replies):
+            category = normalize_category(reply)
+            if category is None:
+                # Only listed categories are cached; anything else gets the classifier's guess for this item
+                logger.warning('AI replied with an unknown category, using the local classifier', item=invoice_items[i].get('item'), reply=reply)
+                categories.append(_lookup_category(invoice_items[i].get('item'), sellers[i], cache, classifier, offline=True))
+                continue
+            if cache is not None and invoice_items[i].get('item'):
+                cache.set(invoice_items[i]['item'], sellers[i], category)
+            categories.append((category, CATEGORY_SOURCE_LLM))
+
+    for i, categorized in zip(pending, categories):
+        result[i] = categorized
+    return result
+
+def ai_categorize_batch(invoice_items: List[dict], seller: Optional[str] = None, cap: Optional[SpendCap] = None,
+                        cache: Optional[CategoryCache] = None, classifier: Optional[CategoryClassifier] = None) -> List[Categorized]:
+    """Categorize all items in one request, falling back to per-item calls when the reply can't be parsed.
+
+    Items already in the category cache, or that the local classifier is confident about,
+    are resolved without a request. Returns one (category, source) pair per item.
+    """
+    if not invoice_items:
+        return []
+    return _categorize_items(invoice_items, [seller] * len(invoice_items), cap, cache, classifier)
 
-def ai_description(invoice: str):
-    return ai(describe_model, describe_prompt, invoice)
+def ai_description(invoice: Invoice, timeout: Optional[float] = None, cap: Optional[SpendCap] = None):
+    kwargs = {'timeout': timeout} if timeout else {}
+    return ai(describe_model, describe_prompt, compact_invoice(invoice), cap, **kwargs)
 
 
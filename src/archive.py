@@ -0,0 +1,62 @@
+import json
+import zlib
+import structlog
+from bson.binary import Binary
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+
+logger = structlog.get_logger()
+
+
+def _pack(data) -> Binary:
+    return Binary(zlib.compress(json.dumps(data, ensure_ascii=False).encode('utf-8'), 9))
+
+
+def _unpack(blob: bytes):
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+class RawArchive:
+    """Compressed copies of the raw portal responses for each invoice, keyed by invoice number.
+
+    Issued invoices never change, so an archived invoice can be rebuilt (and re-categorized)
+    without calling einvoice.nat.gov.tw again. The collection is shared by all accounts; each
+    document records its `account` and an archive only sees its own account's documents.
+    """
+
+    def __init__(self, collection, account: str):
+        self.collection = collection
+        self.account = account
+        self.collection.create_index("account")
+
+    def save(self, listing: Dict, detail: List[Dict], data: Dict) -> None:
+        self.collection.update_one(
+            {"_id": listing['invoiceNumber']},
+            {"$set": {"account": self.account, "listing": _pack(listing), "detail": _pack(detail), "data": _pack(data), "archived_at": datetime.now()}},
+            upsert=True,
+        )
+
+    def load(self, invoice_number: str) -> Optional[Dict]:
+        doc = self.collection.find_one({"_id": invoice_number, "account": self.account})
+        return self._unpack_doc(doc) if doc else None
+
+    def iter_records(self, invoice_numbers: Optional[List[str]] = None, batch_size: int = 200) -> Iterator[Dict]:
+        query = {"_id": {"$in": invoice_numbers}, "account": self.account} if invoice_numbers else {"account": self.account}
+        for doc in self.collection.find(query).batch_size(batch_size):
+            yield self._unpack_doc(doc)
+
+    def adopt(self, invoice_collection, batch_size: int = 500) -> int:
+        """Assign documents archived before accounts were recorded to this account, if its collection holds the invoice."""
+        adopted = 0
+        ids = [doc["_id"] for doc in self.collection.find({"account": {"$exists": False}}, {"_id": 1})]
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            owned = [doc["invoice_number"] for doc in invoice_collection.find({"invoice_number": {"$in": batch}}, {"invoice_number": 1})]
+            if owned:
+                adopted += self.collection.update_many({"_id": {"$in": owned}, "account": {"$exists": False}}, {"$set": {"account": self.account}}).modified_count
+        logger.info('Archived responses assigned to account', account=self.account, adopted=adopted)
+        return adopted
+
+    @staticmethod
+    def _unpack_doc(doc) -> Dict:
+        return {"listing": _unpack(doc['listing']), "detail": _unpack(doc['detail']), "data": _unpack(doc['data'])}
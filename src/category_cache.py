@@ -0,0 +1,96 @@
+import os
+import re
+import threading
+import unicodedata
+import structlog
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+from pymongo.errors import OperationFailure
+
+CACHE_TTL = int(os.getenv("CATEGORY_CACHE_TTL", 90 * 24 * 60 * 60))
+CACHE_SIZE = int(os.getenv("CATEGORY_CACHE_SIZE", 4096))
+
+logger = structlog.get_logger()
+
+
+def normalize_name(name: Optional[str]) -> str:
+    name = unicodedata.normalize('NFKC', name or '').lower()
+    return re.sub(r'\s+', ' ', name).strip()
+
+
+def cache_key(item_name: str, seller: Optional[str]) -> str:
+    return f"{normalize_name(seller)}|{normalize_name(item_name)}"
+
+
+class CategoryCache:
+    """Item category cache: an in-process LRU in front of a MongoDB collection.
+
+    Entries are tagged with `version` (derived from the categorize model and prompt),
+    so changing the prompt invalidates them. MongoDB expires stale entries via a TTL index.
+    """
+
+    def __init__(self, collection, version: str, ttl: int = CACHE_TTL, maxsize: int = CACHE_SIZE):
+        self.collection = collection
+        self.version = version
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.stats = {'lru_hit': 0, 'db_hit': 0, 'miss': 0}
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._ensure_ttl_index()
+
+    def _ensure_ttl_index(self) -> None:
+        try:
+            self.collection.create_index("updated_at", expireAfterSeconds=self.ttl)
+        except OperationFailure:
+            # The index already exists with another CATEGORY_CACHE_TTL; change its expiry in place
+            self.collection.database.command("collMod", self.collection.name, index={"keyPattern": {"updated_at": 1}, "expireAfterSeconds": self.ttl})
+            logger.info('Category cache TTL changed', ttl=self.ttl)
+
+    def _remember(self, key: str, category: str, expires_at: datetime) -> None:
+        with self._lock:
+            self._lru[key] = (category, expires_at)
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.maxsize:
+                self._lru.popitem(last=False)
+
+    def get(self, item_name: str, seller: Optional[str] = None) -> Optional[str]:
+        key = cache_key(item_name, seller)
+        now = datetime.now()
+        with self._lock:
+            cached = self._lru.get(key)
+            if cached is not None and cached[1] > now:
+                self._lru.move_to_end(key)
+                self.stats['lru_hit'] += 1
+                return cached[0]
+
+        doc = self.collection.find_one({"_id": key, "version": self.version})
+        if doc is not None and doc['updated_at'] + timedelta(seconds=self.ttl) > now:
+            self._remember(key, doc['category'], doc['updated_at'] + timedelta(seconds=self.ttl))
+            with self._lock:
+                self.stats['db_hit'] += 1
+            return doc['category']
+
+        with self._lock:
+            self.stats['miss'] += 1
+        return None
+
+    def set(self, item_name: str, seller: Optional[str], category: Optional[str]) -> None:
+        if not category:
+            return
+        key = cache_key(item_name, seller)
+        now = datetime.now()
+        self.collection.update_one(
+            {"_id": key},
+            {"$set": {"category": category, "version": self.version, "updated_at": now}},
+            upsert=True,
+        )
+        self._remember(key, category, now + timedelta(seconds=self.ttl))
+
+    def hit_rate(self) -> float:
+        total = sum(self.stats.values())
+        return (self.stats['lru_hit'] + self.stats['db_hit']) / total if total else 0.0
+
+    def log_stats(self) -> None:
+        logger.info('Category cache stats', hit_rate=round(self.hit_rate(), 3), **self.stats)
@@ -1,78 +1,276 @@
-CHROME_JSON_URL = 'https://googlechromelabs.github.io/chrome-for-testing/last-known-good-versions-with-downloads.json'
 import os
+import json
+import time
+import fcntl
+import base64
 import shutil
+import hashlib
+import subprocess
 import zipfile
 import requests
 import structlog
-from tqdm import tqdm
 from pathlib import Path
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+CHROME_JSON_URL = os.getenv("CHROME_JSON_URL", 'https://googlechromelabs.github.io/chrome-for-testing/last-known-good-versions-with-downloads.json')
+# Lists every released version, used when CHROME_VERSION pins one
+CHROME_VERSIONS_URL = os.getenv("CHROME_VERSIONS_URL", 'https://googlechromelabs.github.io/chrome-for-testing/known-good-versions-with-downloads.json')
+CHROME_VERSION = os.getenv("CHROME_VERSION", None)
+CHROME_CHANNEL = os.getenv("CHROME_CHANNEL", "Stable")
+# Inside the ./:/app volume, so container rebuilds reuse the installed versions
+CHROME_CACHE_DIR = Path(os.getenv("CHROME_CACHE_DIR", ".chrome"))
+CHROME_PLATFORM = "linux64"
+CHROME_ARCHIVES = ("chrome-headless-shell", "chromedriver")
+# Where older releases extracted Chrome, straight into the working directory
+LEGACY_DIRS = tuple(Path(f"{archive}-{CHROME_PLATFORM}") for archive in CHROME_ARCHIVES)
+# Installed versions kept on disk: the current one and the one it replaced
+KEEP_VERSIONS = 2
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
 logger = structlog.get_logger()
 
-def download_with_progress(url, filename):
-    response = requests.get(url, stream=True)
-    response.raise_for_status()
-    total = int(response.headers.get('content-length', 0))
-    with open(filename, 'wb') as file, tqdm(
-        desc=filename,
-        total=total,
-        unit='B',
-        unit_scale=True,
-        unit_divisor=1024,
-    ) as bar:
-        for data in response.iter_content(chunk_size=1024):
-            size = file.write(data)
-            bar.update(size)
-
-def check_chrome_exists(force_redownload: bool = False) -> None:
-    logger.info("Checking Chrome installation")
-    if Path('chrome-headless-shell-linux64').exists() and Path('chromedriver-linux64').exists():
-        logger.info("Chrome and ChromeDriver are already installed.")
-        if not force_redownload:
-            return
-        else:
-            shutil.rmtree('chrome-headless-shell-linux64', ignore_errors=True)
-            shutil.rmtree('chromedriver-linux64', ignore_errors=True)
-            logger.info("Forcing re-download of Chrome and ChromeDriver.")
 
-    logger.info("Downloading Chrome and ChromeDriver")
+@contextmanager
+def _install_lock():
+    """Serialize installs across processes sharing the cache (service, CLI scripts)."""
+    CHROME_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(CHROME_CACHE_DIR / '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def resolve_version(version: Optional[str] = CHROME_VERSION) -> Tuple[str, Dict[str, str]]:
+    """Return the version to install and the download URL of each archive for CHROME_PLATFORM.
+
+    A pinned `version` is looked up in CHROME_VERSIONS_URL, otherwise the CHROME_CHANNEL
+    release from CHROME_JSON_URL is used.
+    """
+    if version:
+        with requests.get(CHROME_VERSIONS_URL, timeout=30) as r:
+            r.raise_for_status()
+            entry = next((entry for entry in r.json()['versions'] if entry['version'] == version), None)
+        if entry is None:
+            raise RuntimeError(f"Chrome version {version} not found at {CHROME_VERSIONS_URL}")
+    else:
+        with requests.get(CHROME_JSON_URL, timeout=30) as r:
+            r.raise_for_status()
+            entry = r.json()['channels'][CHROME_CHANNEL]
+
+    urls = {}
+    for archive in CHROME_ARCHIVES:
+        url = next((platform_info['url'] for platform_info in entry.get('downloads', {}).get(archive, []) if platform_info['platform'] == CHROME_PLATFORM), None)
+        if url is None:
+            raise RuntimeError(f"No {archive} download for {CHROME_PLATFORM} in Chrome {entry['version']}")
+        urls[archive] = url
+    return entry['version'], urls
+
+
+def _expected_md5(headers) -> Optional[str]:
+    # Google Cloud Storage advertises the object's MD5 as `x-goog-hash: crc32c=...,md5=<base64>`
+    for part in headers.get('x-goog-hash', '').split(','):
+        if part.strip().startswith('md5='):
+            return base64.b64decode(part.strip()[4:]).hex()
+    content_md5 = headers.get('Content-MD5')
+    return base64.b64decode(content_md5).hex() if content_md5 else None
+
+
+def _verify(path: Path, size: Optional[int], md5: Optional[str]) -> None:
+    if size is not None and path.stat().st_size != size:
+        raise RuntimeError(f"{path.name} is {path.stat().st_size} bytes, expected {size}")
+    if md5 is not None:
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        if digest.hexdigest() != md5:
+            raise RuntimeError(f"{path.name} MD5 {digest.hexdigest()} does not match {md5}")
+    with zipfile.ZipFile(path) as archive:
+        corrupt = archive.testzip()
+    if corrupt is not None:
+        raise RuntimeError(f"{path.name} has a corrupt member: {corrupt}")
+
+
+def download(url: str, path: Path, max_attempts: int = 5) -> Path:
+    """Download `url` to `path` in DOWNLOAD_CHUNK_SIZE chunks, resuming a partial `.part` file with an HTTP range request.
+
+    The finished file is checked against the advertised size and MD5 and must be a valid zip;
+    a file that fails the checks is discarded and downloaded again.
+    """
+    part = path.with_name(path.name + '.part')
+    for attempt in range(max_attempts):
+        try:
+            with requests.head(url, allow_redirects=True, timeout=30) as head:
+                head.raise_for_status()
+                size = int(head.headers['Content-Length']) if 'Content-Length' in head.headers else None
+                md5 = _expected_md5(head.headers)
+
+            offset = part.stat().st_size if part.exists() else 0
+            if size is None or offset < size:
+                headers = {'Range': f'bytes={offset}-'} if offset else {}
+                with requests.get(url, headers=headers, stream=True, timeout=60) as resp:
+                    resp.raise_for_status()
+                    if offset and resp.status_code != 206:
+                        logger.info('Server ignored the range request, restarting download', url=url)
+                        offset = 0
+                    if offset:
+                        logger.info('Resuming Chrome download', file=path.name, offset=offset, size=size)
+                    with open(part, 'ab' if offset else 'wb') as f:
+                        for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+
+            if size is not None and part.stat().st_size < size:
+                # Keep the partial file, the next attempt resumes from where this one stopped
+                raise RuntimeError(f"Download stopped at {part.stat().st_size} of {size} bytes")
+            try:
+                _verify(part, size, md5)
+            except (RuntimeError, zipfile.BadZipFile) as e:
+                part.unlink(missing_ok=True)
+                raise RuntimeError(f"Integrity check failed: {e}") from e
+            os.replace(part, path)
+            logger.info('Chrome archive downloaded', file=path.name, size=path.stat().st_size, md5_checked=md5 is not None)
+            return path
+        except (requests.RequestException, RuntimeError) as e:
+            if attempt == max_attempts - 1:
+                raise RuntimeError(f"Failed to download {url}: {e}") from e
+            delay = min(2 ** attempt, 30)
+            logger.warning('Chrome download failed, retrying', url=url, error=str(e), attempt=attempt + 1, delay=delay)
+            time.sleep(delay)
 
-    with requests.get(CHROME_JSON_URL) as r:
-        r.raise_for_status()
-        chrome_data = r.json()
 
-    # chrome_version = chrome_data['channels']['Stable']['version']
-    for platform_info in chrome_data['channels']['Stable']['downloads']['chrome-headless-shell']:
-        if platform_info['platform'] == 'linux64':
-            chrome_download_url = platform_info['url']
-            break
+def _extract(archive_path: Path, target: Path) -> None:
+    with zipfile.ZipFile(archive_path) as archive:
+        for info in archive.infolist():
+            extracted = archive.extract(info, target)
+            # zipfile drops Unix permissions, which the chrome and chromedriver binaries need
+            mode = info.external_attr >> 16
+            if mode:
+                os.chmod(extracted, mode)
 
-    for platform_info in chrome_data['channels']['Stable']['downloads']['chromedriver']:
-        if platform_info['platform'] == 'linux64':
-            chromedriver_download_url = platform_info['url']
-            break
 
-    chrome_zip = 'chrome-headless-shell.zip'
-    download_with_progress(chrome_download_url, chrome_zip)
+def _activate(version_dir: Path) -> None:
+    """Atomically point CHROME_CACHE_DIR/current at `version_dir`."""
+    current = CHROME_CACHE_DIR / 'current'
+    if current.is_symlink() and os.readlink(current) == version_dir.name:
+        return
+    tmp_link = CHROME_CACHE_DIR / 'current.tmp'
+    tmp_link.unlink(missing_ok=True)
+    tmp_link.symlink_to(version_dir.name)
+    os.replace(tmp_link, current)
+    logger.info('Chrome version activated', version=version_dir.name)
 
-    chromedriver_zip = 'chromedriver.zip'
-    download_with_progress(chromedriver_download_url, chromedriver_zip)
 
-    with zipfile.ZipFile(chrome_zip, 'r') as zip_ref:
-        zip_ref.extractall(os.getcwd())
+def _prune() -> None:
+    current = (CHROME_CACHE_DIR / 'current').resolve()
+    installed = sorted((path for path in CHROME_CACHE_DIR.iterdir() if path.is_dir() and not path.is_symlink() and (path / 'manifest.json').exists()), key=lambda path: path.stat().st_mtime, reverse=True)
+    keep = {current} | {path.resolve() for path in installed[:KEEP_VERSIONS]}
+    for path in installed:
+        if path.resolve() not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+            logger.info('Old Chrome version removed', version=path.name)
 
-    with zipfile.ZipFile(chromedriver_zip, 'r') as zip_ref:
-        zip_ref.extractall(os.getcwd())
 
-    Path(chrome_zip).unlink(missing_ok=True)
-    Path(chromedriver_zip).unlink(missing_ok=True)
+def _legacy_version() -> Optional[str]:
+    try:
+        output = subprocess.run([str(LEGACY_DIRS[1] / 'chromedriver'), '--version'], capture_output=True, text=True, timeout=30).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    # "ChromeDriver 120.0.6099.109 (3419140ab665596f21b385ce136419fde0924272-refs/branch-heads/6099@{#1483})"
+    parts = output.split()
+    return parts[1] if len(parts) > 1 and parts[0] == 'ChromeDriver' else None
 
-def setup_chrome() -> webdriver.Chrome:
-    chrome_binary_path = os.path.join(os.getcwd(), 'chrome-headless-shell-linux64', 'chrome-headless-shell')
-    chromedriver_path = os.path.join(os.getcwd(), 'chromedriver-linux64', 'chromedriver')
+
+def _adopt_legacy() -> None:
+    """Move a Chrome extracted into the working directory by older releases into the cache, or delete it.
+
+    It is adopted as its own version when nothing is active yet and its version can be read
+    from chromedriver; otherwise the cache already has what it needs and the copy is removed.
+    """
+    if not any(path.exists() for path in LEGACY_DIRS):
+        return
+    version = _legacy_version() if all(path.is_dir() for path in LEGACY_DIRS) else None
+    if version and not (CHROME_CACHE_DIR / 'current').exists() and not (CHROME_CACHE_DIR / version).exists():
+        staging = CHROME_CACHE_DIR / f".{version}.tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        for path in LEGACY_DIRS:
+            shutil.move(str(path), str(staging / path.name))
+        (staging / 'manifest.json').write_text(json.dumps({'version': version, 'urls': {}, 'installed_at': time.time(), 'adopted': True}))
+        os.rename(staging, CHROME_CACHE_DIR / version)
+        _activate(CHROME_CACHE_DIR / version)
+        logger.info('Legacy Chrome install adopted', version=version)
+        return
+    for path in LEGACY_DIRS:
+        shutil.rmtree(path, ignore_errors=True)
+    logger.info('Legacy Chrome install removed', version=version)
+
+
+def install(version: str, urls: Dict[str, str]) -> Path:
+    """Download both archives concurrently, extract them next to the cache and move the result into place in one rename."""
+    downloads = CHROME_CACHE_DIR / 'downloads'
+    downloads.mkdir(parents=True, exist_ok=True)
+    logger.info('Downloading Chrome and ChromeDriver', version=version)
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        archives = dict(zip(urls, executor.map(lambda archive: download(urls[archive], downloads / f"{archive}-{version}.zip"), urls)))
+
+    target = CHROME_CACHE_DIR / version
+    staging = CHROME_CACHE_DIR / f".{version}.tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    for archive_path in archives.values():
+        _extract(archive_path, staging)
+    (staging / 'manifest.json').write_text(json.dumps({'version': version, 'urls': urls, 'installed_at': time.time()}))
+
+    if target.exists():
+        retired = CHROME_CACHE_DIR / f".{version}.old"
+        shutil.rmtree(retired, ignore_errors=True)
+        os.rename(target, retired)
+        os.rename(staging, target)
+        shutil.rmtree(retired, ignore_errors=True)
+    else:
+        os.rename(staging, target)
+    for archive_path in archives.values():
+        archive_path.unlink(missing_ok=True)
+    return target
+
+
+def ensure_chrome(version: Optional[str] = CHROME_VERSION, force_redownload: bool = False) -> Path:
+    """Return the directory of the Chrome version to use, installing it first if it is not cached.
+
+    Without a pinned `version` the active install is reused as is and the network is only
+    touched when nothing is installed yet. `force_redownload` fetches the version again and
+    replaces the cached copy only once the new one is complete.
+    """
+    with _install_lock():
+        _adopt_legacy()
+        current = CHROME_CACHE_DIR / 'current'
+        if not force_redownload:
+            if version is None and (current / 'manifest.json').exists():
+                return current
+            if version is not None and (CHROME_CACHE_DIR / version / 'manifest.json').exists():
+                _activate(CHROME_CACHE_DIR / version)
+                return current
+
+        version, urls = resolve_version(version)
+        version_dir = CHROME_CACHE_DIR / version
+        if force_redownload or not (version_dir / 'manifest.json').exists():
+            install(version, urls)
+        _activate(version_dir)
+        _prune()
+        return current
+
+
+def setup_chrome(install_dir: Optional[Path] = None) -> 'webdriver.Chrome':
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service
+    from selenium.webdriver.chrome.options import Options
+
+    install_dir = Path(install_dir or CHROME_CACHE_DIR / 'current')
+    chrome_binary_path = os.path.join(install_dir, 'chrome-headless-shell-linux64', 'chrome-headless-shell')
+    chromedriver_path = os.path.join(install_dir, 'chromedriver-linux64', 'chromedriver')
     if not os.path.exists(chrome_binary_path):
         raise FileNotFoundError(f"Chrome binary not found at: {chrome_binary_path}")
     if not os.path.exists(chromedriver_path):
@@ -92,4 +290,3 @@ def setup_chrome() -> webdriver.Chrome:
     service = Service(chromedriver_path)
     driver = webdriver.Chrome(service=service, options=chrome_options)
     return driver
-
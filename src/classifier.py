@@ -0,0 +1,75 @@
+import os
+import structlog
+from typing import Iterable, Optional, Tuple
+
+from src.category_cache import normalize_name
+from src.einvoice import CATEGORY_SOURCE_LLM, CATEGORY_SOURCE_CACHE
+
+CLASSIFIER_PATH = os.getenv("CLASSIFIER_PATH", "category_classifier.joblib")
+
+logger = structlog.get_logger()
+
+
+def _features(item_name: str, seller: Optional[str]) -> str:
+    return f"{normalize_name(seller)} | {normalize_name(item_name)}"
+
+
+class CategoryClassifier:
+    """CPU-only item category classifier: TF-IDF character n-grams fed to a logistic regression."""
+
+    def __init__(self, pipeline: 'Pipeline'):
+        self.pipeline = pipeline
+
+    @classmethod
+    def load(cls, path: str = CLASSIFIER_PATH) -> Optional['CategoryClassifier']:
+        if not os.path.exists(path):
+            logger.info('No category classifier model found', path=path)
+            return None
+        import joblib
+        logger.info('Loading category classifier', path=path)
+        return cls(joblib.load(path))
+
+    def predict(self, item_name: str, seller: Optional[str] = None) -> Tuple[str, float]:
+        probabilities = self.pipeline.predict_proba([_features(item_name, seller)])[0]
+        best = probabilities.argmax()
+        return str(self.pipeline.classes_[best]), float(probabilities[best])
+
+
+# The cache only ever holds OpenAI's answers; the classifier's own guesses would just reinforce its mistakes
+TRAINING_SOURCES = (CATEGORY_SOURCE_LLM, CATEGORY_SOURCE_CACHE)
+
+
+def iter_labelled_items(collection, allowed_categories: Iterable[str]) -> Iterable[Tuple[str, str]]:
+    """Yield (features, category) for items OpenAI categorized; items stored without a category_source are skipped."""
+    allowed = set(allowed_categories)
+    query = {"items.category_source": {"$in": list(TRAINING_SOURCES)}}
+    for doc in collection.find(query, {"seller_name": 1, "items": 1}):
+        for item in doc.get('items', []):
+            if item.get('category_source') in TRAINING_SOURCES and item.get('ai_category') in allowed and item.get('item_name'):
+                yield _features(item['item_name'], doc.get('seller_name')), item['ai_category']
+
+
+def train_classifier(collections: Iterable, allowed_categories: Iterable[str], path: str = CLASSIFIER_PATH) -> CategoryClassifier:
+    """Train on the LLM-labelled items stored in `collections` and save the model to `path`."""
+    import joblib
+    from sklearn.pipeline import Pipeline
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    allowed_categories = list(allowed_categories)
+    samples = [sample for collection in collections for sample in iter_labelled_items(collection, allowed_categories)]
+    if len({label for _, label in samples}) < 2:
+        raise RuntimeError(f"Not enough labelled items to train a classifier, got {len(samples)} items")
+
+    texts, labels = zip(*samples)
+    pipeline = Pipeline([
+        ('tfidf', TfidfVectorizer(analyzer='char_wb', ngram_range=(1, 3), sublinear_tf=True)),
+        ('clf', LogisticRegression(max_iter=1000, class_weight='balanced')),
+    ])
+    pipeline.fit(texts, labels)
+
+    tmp_path = f"{path}.tmp"
+    joblib.dump(pipeline, tmp_path)
+    os.replace(tmp_path, path)
+    logger.info('Category classifier trained', samples=len(samples), classes=list(pipeline.classes_), path=path)
+    return CategoryClassifier(pipeline)
@@ -1,39 +1,110 @@
 import os
 import time
 import pytz
-import ddddocr
+import random
 import requests
+import threading
 import structlog
-from typing import Optional, List, Dict, Tuple, Callable
+from typing import Optional, List, Dict, Tuple, Callable, Iterator
 from datetime import datetime
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+from requests.adapters import HTTPAdapter
 
-from src.chrome import setup_chrome
+from src.session_store import SESSION_PATH, load_session, save_session, clear_session
+from src.metrics import metrics, timed, timed_function, Timer
 
-INVOICE_PHONE = os.getenv("EINVOICE_PHONE", None)
-INVOICE_PASSWORD = os.getenv("EINVOICE_PASSWORD", None)
-
-if INVOICE_PHONE is None or INVOICE_PASSWORD is None:
-    raise RuntimeError("EINVOICE_PHONE and EINVOICE_PASSWORD environment variables must be set")
+API_BASE = os.getenv("EINVOICE_API_BASE", "https://service-mc.einvoice.nat.gov.tw")
+MAX_WORKERS = int(os.getenv("EINVOICE_MAX_WORKERS", 4))
+MAX_RPS = float(os.getenv("EINVOICE_MAX_RPS", 2))
+HTTP_POOL_SIZE = int(os.getenv("EINVOICE_HTTP_POOL_SIZE", 16))
 
 logger = structlog.get_logger()
-ocr = ddddocr.DdddOcr(show_ad=False)
+# Shared by every account: one OCR model, one Chrome login at a time, one connection pool
+_ocr = None
+_ocr_lock = threading.Lock()
+_chrome_lock = threading.Lock()
+_http_adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+
+
+class RateLimiter:
+    """Thread-safe limiter that spaces calls to at most `rate` per second."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def get_ocr():
+    """The captcha OCR model, loaded on first login rather than at import (it is a large ONNX model)."""
+    global _ocr
+    with _ocr_lock:
+        if _ocr is None:
+            import ddddocr
+            _ocr = ddddocr.DdddOcr(show_ad=False)
+    return _ocr
+
+
+def new_session() -> requests.Session:
+    # Cookies and auth headers stay per session, TLS connections are reused across all of them
+    session = requests.Session()
+    session.mount("https://", _http_adapter)
+    session.mount("http://", _http_adapter)
+    return session
+
+
+def post_with_backoff(session: requests.Session, url: str, limiter: Optional[RateLimiter] = None, max_retries: int = 5, **kwargs) -> requests.Response:
+    stage = f"http:{url.rsplit('/', 1)[-1]}"
+    for attempt in range(max_retries + 1):
+        if limiter:
+            limiter.wait()
+        with timed(stage):
+            resp = session.post(url, **kwargs)
+        if resp.status_code != 429 and resp.status_code < 500:
+            return resp
+        if attempt == max_retries:
+            metrics.incr('errors', stage)
+            break
+        metrics.incr('retries', stage)
+        retry_after = resp.headers.get('Retry-After', '')
+        delay = float(retry_after) if retry_after.isdigit() else min(2 ** attempt, 30) + random.uniform(0, 1)
+        logger.warning("Server busy, backing off", url=url, status_code=resp.status_code, attempt=attempt + 1, delay=delay)
+        time.sleep(delay)
+    return resp
+
+def login_and_generate_session(phone: str, password: str) -> Optional[requests.Session]:
+    return login_with_selenium(phone, password)
+
+def login_with_selenium(phone: str, password: str) -> Optional[requests.Session]:
+    with _chrome_lock:
+        return _login_with_selenium(phone, password)
+
+@timed_function('login_selenium')
+def _login_with_selenium(phone: str, password: str) -> Optional[requests.Session]:
+    # Selenium and Chrome are only loaded when a login is actually needed
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from src.chrome import ensure_chrome, setup_chrome
 
-def login_and_generate_session() -> Optional[requests.Session]:
     logger.info("Starting login process")
-    chrome_driver = setup_chrome()
+    chrome_driver = setup_chrome(ensure_chrome())
     chrome_driver.get("https://www.einvoice.nat.gov.tw/accounts/login/mw")
     WebDriverWait(chrome_driver, 10).until(
         EC.presence_of_element_located((By.CLASS_NAME, "code_num"))
     )
-    chrome_driver.find_element(By.ID, "mobile_phone").send_keys(INVOICE_PHONE)
-    chrome_driver.find_element(By.ID, "password").send_keys(INVOICE_PASSWORD)
+    chrome_driver.find_element(By.ID, "mobile_phone").send_keys(phone)
+    chrome_driver.find_element(By.ID, "password").send_keys(password)
+    # The captcha is read straight from the screenshot bytes, nothing is written to disk
     code_num_img = chrome_driver.find_element(By.CLASS_NAME, "code_num").find_element(By.TAG_NAME, "img")
-    code_num_img.screenshot("code_num.png")
-    with open("code_num.png", "rb") as f:
-        code_num = ocr.classification(f.read())
+    code_num = get_ocr().classification(code_num_img.screenshot_as_png)
 
     chrome_driver.find_element(By.ID, "captcha").send_keys(code_num)
     chrome_driver.find_element(By.ID, "submitBtn").click()
@@ -46,13 +117,11 @@ def login_and_generate_session() -> Optional[requests.Session]:
         WebDriverWait(chrome_driver, 10).until(
             EC.presence_of_element_located((By.CLASS_NAME, "code_num"))
         )
-        chrome_driver.find_element(By.ID, "mobile_phone").send_keys(INVOICE_PHONE)
-        chrome_driver.find_element(By.ID, "password").send_keys(INVOICE_PASSWORD)
+        chrome_driver.find_element(By.ID, "mobile_phone").send_keys(phone)
+        chrome_driver.find_element(By.ID, "password").send_keys(password)
         logger.error("Captcha verification failed, retrying", attempt=attempt + 1)
         code_num_img = chrome_driver.find_element(By.CLASS_NAME, "code_num").find_element(By.TAG_NAME, "img")
-        code_num_img.screenshot("code_num.png")
-        with open("code_num.png", "rb") as f:
-            code_num = ocr.classification(f.read())
+        code_num = get_ocr().classification(code_num_img.screenshot_as_png)
 
         chrome_driver.find_element(By.ID, "captcha").send_keys(code_num)
         chrome_driver.find_element(By.ID, "submitBtn").click()
@@ -71,7 +140,7 @@ def login_and_generate_session() -> Optional[requests.Session]:
     if token is None:
         token = chrome_driver.execute_script("return window.sessionStorage.getItem('token');")
 
-    session = requests.Session()
+    session = new_session()
     for cookie in cookies:
         session.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'], secure=cookie['secure'], rest={'httpOnly': cookie.get('httpOnly', None), 'sameSite': cookie.get('sameSite', 'Lax'), 'expiry': cookie.get('expiry', None)})
 
@@ -90,6 +159,24 @@ def login_and_generate_session() -> Optional[requests.Session]:
 
     return session
 
+def get_session(phone: str, password: str, session_path: str = SESSION_PATH) -> requests.Session:
+    """Reuse the stored login session, only launching Chrome when the store is empty or expired."""
+    session = load_session(new_session(), session_path)
+    if session is not None:
+        return session
+
+    with timed('login') as timer:
+        session = login_and_generate_session(phone, password)
+    save_session(session, session_path)
+    logger.info("Login complete", duration=timer.elapsed)
+    time.sleep(3)
+    return session
+
+def relogin(phone: str, password: str, session_path: str = SESSION_PATH) -> requests.Session:
+    clear_session(session_path)
+    return get_session(phone, password, session_path)
+
+@timed_function('jwt')
 def get_JWT_with_time_range(session: requests.Session, start_time: datetime, end_time: datetime, relogin_func: Callable) -> Tuple[requests.Session, str]:
     logger.info("Fetching JWT token for invoice data", start_time=start_time, end_time=end_time)
 
@@ -112,89 +199,120 @@ def get_JWT_with_time_range(session: requests.Session, start_time: datetime, end
     attempt = 0
     while True:
         ok = False
-        resp = session.options("https://service-mc.einvoice.nat.gov.tw/btc/cloud/api/btc502w/getSearchCarrierInvoiceListJWT", json=payload)
+        resp = session.options(f"{API_BASE}/btc/cloud/api/btc502w/getSearchCarrierInvoiceListJWT", json=payload)
         if resp.status_code == 200:
             ok = True
         if resp.status_code in (401, 403):
             logger.warning("Auth error on OPTIONS, will try relogin if allowed", status_code=resp.status_code)
         time.sleep(1.5)
 
-        if not ok:
-            if resp.status_code in (401, 403) and relogin_func and attempt < 10:
-                attempt += 1
-                logger.info("Re-login and retry get_JWT_with_time_range", attempt=attempt)
-                session = relogin_func()
-                continue
-            elif resp.status_code in (401, 403):
-                raise RuntimeError(f"Auth failed on OPTIONS and relogin not available or exceeded.", status_code=resp.status_code, response=resp.text)
-            else:
-                raise RuntimeError(f"Failed to fetch JWT token [options] after retries", status_code=resp.status_code, response=resp.text)
-
-        resp = session.post("https://service-mc.einvoice.nat.gov.tw/btc/cloud/api/btc502w/getSearchCarrierInvoiceListJWT", json=payload)
-        if resp.status_code == 200:
-            jwt_token = resp.text.strip()
-            if not jwt_token:
-                raise RuntimeError("Empty JWT token returned")
-            return session, jwt_token
-
-
-def get_invoice_list(session: requests.Session, jwt_token: str, size: int = 100) -> List[Dict]:
+        if ok:
+            resp = session.post(f"{API_BASE}/btc/cloud/api/btc502w/getSearchCarrierInvoiceListJWT", json=payload)
+            if resp.status_code == 200:
+                jwt_token = resp.text.strip()
+                if not jwt_token:
+                    raise RuntimeError("Empty JWT token returned")
+                return session, jwt_token
+            if resp.status_code in (401, 403):
+                logger.warning("Auth error on POST, will try relogin if allowed", status_code=resp.status_code)
+
+        if resp.status_code in (401, 403) and relogin_func and attempt < 10:
+            attempt += 1
+            logger.info("Re-login and retry get_JWT_with_time_range", attempt=attempt)
+            session = relogin_func()
+            continue
+        elif resp.status_code in (401, 403):
+            raise RuntimeError(f"Auth failed and relogin not available or exceeded, status code: {resp.status_code}, response: {resp.text}")
+        else:
+            raise RuntimeError(f"Failed to fetch JWT token, status code: {resp.status_code}, response: {resp.text}")
+
+
+class AdaptiveDelay:
+    """Inter-page delay that shrinks while the API is healthy and grows on errors or rate-limit headers."""
+
+    def __init__(self, initial: float = 1.0, minimum: float = 0.2, maximum: float = 30.0):
+        self.delay = initial
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def observe(self, resp: requests.Response) -> None:
+        retry_after = resp.headers.get('Retry-After', '')
+        remaining = resp.headers.get('X-RateLimit-Remaining', '')
+        if resp.status_code == 429 or resp.status_code >= 500:
+            self.delay = max(self.delay * 2, float(retry_after) if retry_after.isdigit() else 0)
+        elif retry_after.isdigit():
+            self.delay = max(self.delay, float(retry_after))
+        elif remaining.isdigit() and int(remaining) <= 1:
+            self.delay *= 2
+        else:
+            self.delay *= 0.75
+        self.delay = min(self.maximum, max(self.minimum, self.delay))
+
+    def wait(self) -> None:
+        time.sleep(self.delay)
+
+
+def iter_invoice_pages(session: requests.Session, jwt_token: str, size: int = 100) -> Iterator[List[Dict]]:
+    """Yield the invoice list one page at a time, so callers can process a page while the next one loads."""
     logger.info("Fetching invoice list", size=size)
     payload = {'token': jwt_token}
+    delay = AdaptiveDelay()
+    timer = Timer()
 
-    resp = session.options("https://service-mc.einvoice.nat.gov.tw/btc/cloud/api/btc502w/searchCarrierInvoice", json=payload, params={'size': size})
+    resp = session.options(f"{API_BASE}/btc/cloud/api/btc502w/searchCarrierInvoice", json=payload, params={'size': size})
     if resp.status_code != 200:
         raise RuntimeError(f"Failed to fetch invoice list [options], status code: {resp.status_code}, response: {resp.text}")
 
-    resp = session.post("https://service-mc.einvoice.nat.gov.tw/btc/cloud/api/btc502w/searchCarrierInvoice", json=payload, params={'size': size})
+    resp = post_with_backoff(session, f"{API_BASE}/btc/cloud/api/btc502w/searchCarrierInvoice", json=payload, params={'size': size})
     if resp.status_code > 400:
         raise RuntimeError(f"Failed to fetch invoice list [post], status code: {resp.status_code}, response: {resp.text}")
 
     if resp.status_code == 204:
-        return []
-    resp = resp.json()
-    result_list = []
-
-    if resp.get('totalPages', 1) > 1:
-        for page in range(2, resp['totalPages'] + 1):
-            logger.info("Fetching additional invoice list page", page=page)
-            payload = {'token': jwt_token}
-            resp_page = session.post("https://service-mc.einvoice.nat.gov.tw/btc/cloud/api/btc502w/searchCarrierInvoice", json=payload, params={'size': size, 'page': page})
-            if resp_page.status_code != 200:
-                raise RuntimeError(f"Failed to fetch invoice list page {page} [post], status code: {resp_page.status_code}, response: {resp_page.text}")
-            resp_page = resp_page.json()
-            result_list.extend(resp_page.get('content', []))
-
-            time.sleep(3) # avoid hitting rate limits
-    else:
-        result_list.extend(resp.get('content', []))
-    logger.info("Invoice list fetching complete", total_invoices=len(result_list))
-    return result_list
-
-
-def get_invoice_datetime(session: requests.Session, invoice_token: str) -> datetime:
+        return
+    delay.observe(resp)
+    first_page = resp.json()
+    total_invoices = len(first_page.get('content', []))
+    yield first_page.get('content', [])
+
+    # `number` is the index of the page just served; follow on from it whether the API counts from 0 or 1
+    next_page = first_page.get('number', 1) + 1
+    for page in range(next_page, next_page + first_page.get('totalPages', 1) - 1):
+        delay.wait()
+        logger.info("Fetching additional invoice list page", page=page, delay=round(delay.delay, 2))
+        resp_page = post_with_backoff(session, f"{API_BASE}/btc/cloud/api/btc502w/searchCarrierInvoice", json=payload, params={'size': size, 'page': page})
+        delay.observe(resp_page)
+        if resp_page.status_code != 200:
+            raise RuntimeError(f"Failed to fetch invoice list page {page} [post], status code: {resp_page.status_code}, response: {resp_page.text}")
+        content = resp_page.json().get('content', [])
+        if not content:
+            break
+        total_invoices += len(content)
+        yield content
+    logger.info("Invoice list fetching complete", total_invoices=total_invoices, duration=timer.elapsed)
+
+
+def get_invoice_data(session: requests.Session, invoice_token: str, limiter: Optional[RateLimiter] = None) -> Dict:
     logger.info("Fetching invoice time")
     payload = invoice_token
 
-    resp = session.post("https://service-mc.einvoice.nat.gov.tw/btc/cloud/api/common/getCarrierInvoiceData", json=payload)
+    resp = post_with_backoff(session, f"{API_BASE}/btc/cloud/api/common/getCarrierInvoiceData", limiter=limiter, json=payload)
 
     if resp.status_code != 200:
         raise RuntimeError(f"Failed to fetch invoice time [post], status code: {resp.status_code}, response: {resp.text}")
-    
-    invoice_date = resp.json()['invoiceDate']
-    invoice_time = resp.json()['invoiceTime']
 
-    result = datetime.strptime(f"{invoice_date} {invoice_time}", "%Y%m%d %H:%M:%S")
+    return resp.json()
 
-    return result
+def parse_invoice_datetime(invoice_data: Dict) -> datetime:
+    return datetime.strptime(f"{invoice_data['invoiceDate']} {invoice_data['invoiceTime']}", "%Y%m%d %H:%M:%S")
 
-def get_invoice_detail(session: requests.Session, invoice_token: str) -> List[dict]:
+def get_invoice_detail(session: requests.Session, invoice_token: str, limiter: Optional[RateLimiter] = None) -> List[dict]:
     logger.info("Fetching invoice detail")
     payload = invoice_token
 
-    resp = session.post("https://service-mc.einvoice.nat.gov.tw/btc/cloud/api/common/getCarrierInvoiceDetail", json=payload, params={'size': 100})
+    resp = post_with_backoff(session, f"{API_BASE}/btc/cloud/api/common/getCarrierInvoiceDetail", limiter=limiter, json=payload, params={'size': 100})
 
     if resp.status_code != 200:
         raise RuntimeError(f"Failed to fetch invoice detail [post], status code: {resp.status_code}, response: {resp.text}")
 
-    return resp.json()['content']
\ No newline at end of file
+    return resp.json()['content']
+
@@ -0,0 +1,102 @@
+import os
+import threading
+import structlog
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import ReturnDocument
+from typing import Callable, Dict, Iterable, Optional
+from src.ai import AIBudgetExceeded, track_usage, usage_totals
+from src.einvoice import Invoice, DESCRIPTION_PENDING, DESCRIPTION_DONE, DESCRIPTION_FAILED
+from src.metrics import metrics, timed
+
+DESCRIBE_WORKERS = int(os.getenv("DESCRIBE_WORKERS", 2))
+# Seconds one description request may take before it is abandoned and retried on a later sync
+DESCRIBE_TIMEOUT = float(os.getenv("DESCRIBE_TIMEOUT", 30))
+DESCRIBE_MAX_ATTEMPTS = int(os.getenv("DESCRIBE_MAX_ATTEMPTS", 5))
+
+logger = structlog.get_logger()
+
+
+class DescriptionWorker:
+    """Fills in the AI description of invoices that were saved with a pending one.
+
+    Descriptions are generated by a small thread pool off the sync's critical path. Each
+    result is written to the invoice document and reported to `on_described`, e.g. to
+    update the Telegram message. A failed or timed-out call leaves the invoice pending
+    and counts an attempt; `retry_pending` picks those up again until
+    DESCRIBE_MAX_ATTEMPTS is reached and the invoice is marked failed. A call refused by
+    the AI spend cap stays pending without counting an attempt.
+
+    The OpenAI usage of each call is added to the invoice's `ai_usage.describe` and
+    reported to `on_usage`, e.g. for the monthly AI rollup.
+    """
+
+    def __init__(self, collection, describe: Callable[[Invoice, float], Optional[str]], on_described: Optional[Callable[[str], None]] = None, on_usage: Optional[Callable[[Invoice, Dict[str, float]], None]] = None, workers: int = DESCRIBE_WORKERS, timeout: float = DESCRIBE_TIMEOUT):
+        self.collection = collection
+        self.describe = describe
+        self.on_described = on_described
+        self.on_usage = on_usage
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='describe')
+        self.in_flight = set()
+        self._lock = threading.Lock()
+
+    def submit(self, invoices: Iterable[Invoice]) -> None:
+        for invoice in invoices:
+            with self._lock:
+                if invoice.invoice_number in self.in_flight:
+                    continue
+                self.in_flight.add(invoice.invoice_number)
+            self.executor.submit(self._describe, invoice)
+
+    def retry_pending(self, limit: int = 200) -> int:
+        """Queue invoices whose description is still pending, e.g. after a failure or a restart."""
+        docs = self.collection.find({"description_status": DESCRIPTION_PENDING}).limit(limit)
+        invoices = [Invoice.from_dict(doc) for doc in docs]
+        if invoices:
+            logger.info('Retrying pending invoice descriptions', invoices=len(invoices))
+        self.submit(invoices)
+        return len(invoices)
+
+    def close(self) -> None:
+        """Wait for queued descriptions to finish."""
+        self.executor.shutdown(wait=True)
+
+    def _describe(self, invoice: Invoice) -> None:
+        try:
+            self._fill_in(invoice)
+        except Exception as e:
+            logger.error('Failed to update invoice description', invoice=invoice.invoice_number, error=str(e))
+        finally:
+            with self._lock:
+                self.in_flight.discard(invoice.invoice_number)
+
+    def _fill_in(self, invoice: Invoice) -> None:
+        try:
+            with track_usage() as calls, timed('describe') as timer:
+                description = self.describe(invoice, self.timeout)
+        except AIBudgetExceeded as e:
+            logger.info('Invoice description deferred', invoice=invoice.invoice_number, reason=str(e))
+            return
+        except Exception as e:
+            usage = self._usage_update(invoice, calls)
+            doc = self.collection.find_one_and_update({"invoice_number": invoice.invoice_number}, {"$inc": {"description_attempts": 1, **usage}}, return_document=ReturnDocument.AFTER)
+            attempts = (doc or {}).get("description_attempts", 1)
+            metrics.incr('retries', 'describe')
+            if attempts < DESCRIBE_MAX_ATTEMPTS:
+                logger.warning('Invoice description failed, will retry', invoice=invoice.invoice_number, attempts=attempts, error=str(e))
+                return
+            self.collection.update_one({"invoice_number": invoice.invoice_number}, {"$set": {"description_status": DESCRIPTION_FAILED}})
+            logger.error('Giving up on invoice description', invoice=invoice.invoice_number, attempts=attempts, error=str(e))
+        else:
+            usage = self._usage_update(invoice, calls)
+            self.collection.update_one({"invoice_number": invoice.invoice_number}, {"$set": {"ai_description": description, "description_status": DESCRIPTION_DONE}, **({"$inc": usage} if usage else {})})
+            logger.info('Invoice description saved', invoice=invoice.invoice_number, duration=timer.elapsed)
+        if self.on_described is not None:
+            self.on_described(invoice.invoice_number)
+
+    def _usage_update(self, invoice: Invoice, calls) -> Dict[str, float]:
+        """Report the usage of this attempt and return it as $inc fields of the invoice document."""
+        usage = usage_totals(calls)
+        if usage and self.on_usage is not None:
+            self.on_usage(invoice, usage)
+        return {f"ai_usage.describe.{key}": value for key, value in usage.items()}
@@ -1,58 +1,160 @@
-from dataclasses import InitVar, dataclass, field, asdict
+from dataclasses import dataclass, field, fields, asdict
 import json
-import urllib
+import urllib.parse
+import structlog
+from datetime import datetime
+from typing import List, Optional, Union
+from pymongo import ReplaceOne, UpdateOne
+from src.metrics import timed
 
-@dataclass
+logger = structlog.get_logger()
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+# ai_description lifecycle: saved as pending, then filled in (done) or given up on (failed) in the background
+DESCRIPTION_PENDING = "pending"
+DESCRIPTION_DONE = "done"
+DESCRIPTION_FAILED = "failed"
+# Where an item's ai_category came from; only OpenAI's answers (fresh or cached) are fit to train the classifier on
+CATEGORY_SOURCE_LLM = "llm"
+CATEGORY_SOURCE_CACHE = "cache"
+CATEGORY_SOURCE_CLASSIFIER = "classifier"
+
+
+def parse_amount(value: Union[str, int, float, None]) -> int:
+    """Portal amounts arrive as strings such as '1,280'; store them as integers (NTD)."""
+    return int(round(parse_number(value)))
+
+
+def parse_number(value: Union[str, int, float, None]) -> float:
+    """Quantities and unit prices may be fractional ('0.345' kg, '29.9' per kg); whole numbers stay ints."""
+    if value is None or value == '':
+        return 0
+    if isinstance(value, str):
+        value = value.replace(',', '').strip()
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+def parse_datetime(value: Union[str, datetime]) -> datetime:
+    return value if isinstance(value, datetime) else datetime.strptime(value, DATETIME_FORMAT)
+
+
+@dataclass(slots=True)
 class InvoiceItem:
-    ai_category: str
+    ai_category: Optional[str]
     item_name: str
-    quantity: int
+    quantity: float
     unit_price: float
-    total_price: float
+    total_price: int
+    category_source: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'InvoiceItem':
+        return cls(
+            ai_category=data.get('ai_category'),
+            category_source=data.get('category_source'),
+            item_name=data['item_name'],
+            quantity=parse_number(data['quantity']),
+            unit_price=parse_number(data['unit_price']),
+            total_price=parse_amount(data['total_price']),
+        )
 
-@dataclass
+@dataclass(slots=True)
 class Invoice:
     invoice_number: str
-    total_amount: float
+    total_amount: int
     seller_name: str
-    invoice_datetime: str
-    ai_description: str
+    invoice_datetime: datetime
+    ai_description: Optional[str]
     items: list[InvoiceItem] = field(default_factory=list)
-
-    mongo_db: InitVar = None
-
-    def __post_init__(self, mongo_db):
-        if mongo_db is not None:
-            self.is_in_mongo = mongo_db.invoice_collection.find_one({"invoice_number": self.invoice_number}) is not None
-            if not self.is_in_mongo: self.to_mongo(mongo_db)
+    description_status: str = DESCRIPTION_DONE
+    telegram_message_id: Optional[int] = None
+    # OpenAI usage per task ("categorize", "describe"): calls, tokens, seconds and estimated cost
+    ai_usage: dict = field(default_factory=dict)
 
     def to_dict(self):
         return asdict(self)
-    
-    def to_mongo(self, mongo_db):
-        if not self.is_in_mongo:
-            mongo_db.insert_one(self.to_dict())
-            self.is_in_mongo = True
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Invoice':
+        """Build an Invoice from a stored document, coercing legacy string amounts and datetimes."""
+        names = {f.name for f in fields(cls)}
+        values = {key: value for key, value in data.items() if key in names}
+        values['total_amount'] = parse_amount(values['total_amount'])
+        values['invoice_datetime'] = parse_datetime(values['invoice_datetime'])
+        values['items'] = [InvoiceItem.from_dict(item) for item in data.get('items', [])]
+        return cls(**values)
+
+    def to_mongo_operation(self) -> UpdateOne:
+        # Upsert on the invoice number so an invoice that is already stored is never overwritten
+        return UpdateOne({"invoice_number": self.invoice_number}, {"$setOnInsert": self.to_dict()}, upsert=True)
+
+    def to_mongo_replace_operation(self) -> ReplaceOne:
+        return ReplaceOne({"invoice_number": self.invoice_number}, self.to_dict(), upsert=True)
+
+    def to_cashew_transactions(self) -> List[dict]:
+        return [
+            {
+            "date": self.invoice_datetime.strftime(DATETIME_FORMAT),
+            "amount": f"{-item.total_price}",
+            "title": f"{item.item_name}",
+            "category": f"{item.ai_category}",
+            "notes": f"發票號碼: {self.invoice_number}\n賣家: {self.seller_name}\n",
+            } for item in self.items
+        ]
 
     def to_cashew_url(self) -> str:
+        return cashew_url(self.to_cashew_transactions())
+
+
+CASHEW_BASE_URL = "https://cashewapp.web.app/addTransaction"
+
+
+def _cashew_encode(value) -> str:
+    # Cashew expects the JSON payload percent-encoded twice
+    json_str = json.dumps(value, ensure_ascii=False)
+    once = urllib.parse.quote(json_str, safe='')
+    return urllib.parse.quote(once, safe='')
+
+
+def cashew_url(transactions: List[dict]) -> str:
+    return f"{CASHEW_BASE_URL}?JSON={_cashew_encode({'transactions': transactions})}"
+
+
+def save_invoices(mongo_db, invoices: List[Invoice], overwrite: bool = False) -> List[Invoice]:
+    """Persist invoices with a single bulk upsert and return the ones that were newly inserted.
+
+    With `overwrite`, invoices that are already stored are replaced instead of left untouched.
+    """
+    if not invoices:
+        return []
+    operations = [invoice.to_mongo_replace_operation() if overwrite else invoice.to_mongo_operation() for invoice in invoices]
+    with timed('mongo_save') as timer:
+        result = mongo_db.bulk_write(operations, ordered=False)
+    inserted = [invoices[index] for index in sorted(result.upserted_ids)]
+    logger.info('Invoices saved to MongoDB', invoices=len(invoices), inserted=len(inserted), duration=timer.elapsed)
+    return inserted
 
-        data = {
-            'transactions':[
-                {
-                "date": f"{self.invoice_datetime}",
-                "amount": f"{-item.total_price}",
-                "title": f"{item.item_name}",
-                "category": f"{item.ai_category}",
-                "notes": f"發票號碼: {self.invoice_number}\n賣家: {self.seller_name}\n",
-                } for item in self.items
-            ]
-        }
-        
-        base_url = "https://cashewapp.web.app/addTransaction"
-        json_str = json.dumps(data, ensure_ascii=False)
-        once = urllib.parse.quote(json_str, safe='')
-        encoded = urllib.parse.quote(once, safe='')
-
-        return f"{base_url}?JSON={encoded}"
-    
 
+def migrate_invoices(mongo_db, batch_size: int = 500) -> int:
+    """Rewrite documents stored with string datetimes/amounts into the typed schema, in batches."""
+    legacy = {"$or": [
+        {"invoice_datetime": {"$type": "string"}},
+        {"total_amount": {"$type": "string"}},
+        {"items.quantity": {"$type": "string"}},
+        {"items.unit_price": {"$type": "string"}},
+        {"items.total_price": {"$type": ["string", "double"]}},
+    ]}
+    migrated = 0
+    operations = []
+    for doc in mongo_db.find(legacy).batch_size(batch_size):
+        typed = Invoice.from_dict(doc).to_dict()
+        operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": typed}))
+        if len(operations) >= batch_size:
+            migrated += mongo_db.bulk_write(operations, ordered=False).modified_count
+            operations = []
+            logger.info('Migrating invoices', migrated=migrated)
+    if operations:
+        migrated += mongo_db.bulk_write(operations, ordered=False).modified_count
+    logger.info('Invoice migration complete', migrated=migrated)
+    return migrated
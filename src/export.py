@@ -0,0 +1,153 @@
+import os
+import json
+import structlog
+from datetime import datetime
+from typing import Iterator, List
+
+from src.einvoice import Invoice, CASHEW_BASE_URL, _cashew_encode, cashew_url
+
+EXPORT_BATCH_SIZE = 1000
+# Conservative URL length that browsers and Telegram buttons still accept
+CASHEW_MAX_URL_LENGTH = 8000
+CASHEW_MAX_FILE_TRANSACTIONS = 5000
+
+logger = structlog.get_logger()
+
+# Column name and Arrow type alias; pandas and pyarrow are only imported by the writers that need them
+ROW_FIELDS = [
+    ("invoice_datetime", "timestamp[s]"),
+    ("invoice_number", "string"),
+    ("seller_name", "string"),
+    ("item_name", "string"),
+    ("ai_category", "string"),
+    ("quantity", "float64"),
+    ("unit_price", "float64"),
+    ("total_price", "int64"),
+    ("invoice_total_amount", "int64"),
+    ("ai_description", "string"),
+]
+ROW_COLUMNS = [name for name, _ in ROW_FIELDS]
+
+
+def row_schema():
+    import pyarrow as pa
+    return pa.schema([(name, pa.type_for_alias(alias)) for name, alias in ROW_FIELDS])
+
+
+def iter_invoices(collection, start: datetime, end: datetime, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[Invoice]:
+    """Stream invoices in [start, end] in datetime order with a batched cursor."""
+    cursor = collection.find({"invoice_datetime": {"$gte": start, "$lte": end}}, {"_id": 0}).sort("invoice_datetime", 1).batch_size(batch_size)
+    for doc in cursor:
+        yield Invoice.from_dict(doc)
+
+
+def iter_row_chunks(invoices: Iterator[Invoice], chunk_size: int = EXPORT_BATCH_SIZE) -> Iterator[List[dict]]:
+    chunk = []
+    for invoice in invoices:
+        for item in invoice.items:
+            chunk.append({
+                "invoice_datetime": invoice.invoice_datetime,
+                "invoice_number": invoice.invoice_number,
+                "seller_name": invoice.seller_name,
+                "item_name": item.item_name,
+                "ai_category": item.ai_category,
+                "quantity": item.quantity,
+                "unit_price": item.unit_price,
+                "total_price": item.total_price,
+                "invoice_total_amount": invoice.total_amount,
+                "ai_description": invoice.ai_description,
+            })
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def export_csv(invoices: Iterator[Invoice], path: str) -> int:
+    import pandas as pd
+    rows = 0
+    for index, chunk in enumerate(iter_row_chunks(invoices)):
+        pd.DataFrame(chunk, columns=ROW_COLUMNS).to_csv(path, mode='w' if index == 0 else 'a', header=index == 0, index=False, encoding='utf-8-sig' if index == 0 else 'utf-8')
+        rows += len(chunk)
+    logger.info('CSV export complete', path=path, rows=rows)
+    return rows
+
+
+def export_parquet(invoices: Iterator[Invoice], path: str) -> int:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = row_schema()
+    rows = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in iter_row_chunks(invoices):
+            writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+            rows += len(chunk)
+    logger.info('Parquet export complete', path=path, rows=rows)
+    return rows
+
+
+def iter_cashew_url_batches(invoices: Iterator[Invoice], max_length: int = CASHEW_MAX_URL_LENGTH) -> Iterator[str]:
+    """Pack transactions greedily into as few Cashew import URLs as fit within `max_length`.
+
+    Percent-encoding works per character, so a URL's length is the empty payload's length
+    plus each encoded transaction plus one encoded ", " separator between transactions.
+    """
+    base_length = len(cashew_url([]))
+    separator_length = len(_cashew_encode([0, 0])) - 2 * len(_cashew_encode(0)) - len(_cashew_encode([]))
+    batch, length = [], base_length
+    for invoice in invoices:
+        for transaction in invoice.to_cashew_transactions():
+            transaction_length = len(_cashew_encode(transaction))
+            extra = transaction_length + (separator_length if batch else 0)
+            if batch and length + extra > max_length:
+                yield cashew_url(batch)
+                batch, length, extra = [], base_length, transaction_length
+            if base_length + transaction_length > max_length:
+                logger.warning('Cashew transaction too long for a single URL, skipping', title=transaction['title'])
+                continue
+            batch.append(transaction)
+            length += extra
+    if batch:
+        yield cashew_url(batch)
+
+
+def export_cashew_urls(invoices: Iterator[Invoice], path: str) -> int:
+    urls = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for url in iter_cashew_url_batches(invoices):
+            f.write(url + '\n')
+            urls += 1
+    logger.info('Cashew URL export complete', path=path, urls=urls, base_url=CASHEW_BASE_URL)
+    return urls
+
+
+def export_cashew_files(invoices: Iterator[Invoice], path: str, max_transactions: int = CASHEW_MAX_FILE_TRANSACTIONS) -> int:
+    """Write Cashew import payloads ({"transactions": [...]}) as numbered JSON files of up to `max_transactions`."""
+    root, ext = os.path.splitext(path)
+    files, batch = 0, []
+
+    def flush():
+        nonlocal files
+        with open(f"{root}-{files + 1:03d}{ext or '.json'}", 'w', encoding='utf-8') as f:
+            json.dump({'transactions': batch}, f, ensure_ascii=False)
+        files += 1
+
+    for invoice in invoices:
+        for transaction in invoice.to_cashew_transactions():
+            batch.append(transaction)
+            if len(batch) >= max_transactions:
+                flush()
+                batch = []
+    if batch:
+        flush()
+    logger.info('Cashew file export complete', path=path, files=files)
+    return files
+
+
+EXPORTERS = {
+    'csv': export_csv,
+    'parquet': export_parquet,
+    'cashew-urls': export_cashew_urls,
+    'cashew-json': export_cashew_files,
+}
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import bisect
+import functools
+import threading
+import structlog
+from contextlib import contextmanager
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+# The service runs with host networking, so the endpoint stays on loopback unless exposed on purpose
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_SNAPSHOT_PATH = os.getenv("METRICS_SNAPSHOT_PATH", "metrics.json")
+# Latency buckets in seconds, from a cache lookup up to a Chrome login
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+logger = structlog.get_logger()
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+class Metrics:
+    """In-process registry of per-stage latency histograms and counters (calls, errors, retries, ...)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms: Dict[str, Histogram] = defaultdict(Histogram)
+        self.counters: Dict[tuple, int] = defaultdict(int)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def observe(self, stage: str, seconds: float, error: bool = False) -> None:
+        with self._lock:
+            self.histograms[stage].observe(seconds)
+            self.counters[('calls', stage)] += 1
+            if error:
+                self.counters[('errors', stage)] += 1
+
+    def incr(self, name: str, stage: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[(name, stage)] += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stages = {}
+            for stage, histogram in self.histograms.items():
+                calls = self.counters[('calls', stage)]
+                stages[stage] = {
+                    'count': histogram.count,
+                    'sum_seconds': round(histogram.sum, 6),
+                    'avg_seconds': round(histogram.sum / histogram.count, 6) if histogram.count else 0.0,
+                    'error_rate': round(self.counters[('errors', stage)] / calls, 4) if calls else 0.0,
+                }
+            counters = defaultdict(dict)
+            for (name, stage), value in self.counters.items():
+                counters[name][stage] = value
+            return {'timestamp': time.time(), 'stages': stages, 'counters': dict(counters)}
+
+    def render_prometheus(self) -> str:
+        with self._lock:
+            lines = ['# TYPE einvoice_stage_seconds histogram']
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (float('inf'),), histogram.buckets):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'einvoice_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'einvoice_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'einvoice_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f'# TYPE einvoice_{name}_total counter')
+                for (counter_name, stage), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        lines.append(f'einvoice_{name}_total{{stage="{stage}"}} {value}')
+            return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class Timer:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        return round((self.end or time.perf_counter()) - self.start, 4)
+
+
+@contextmanager
+def timed(stage: str):
+    """Record how long the block takes under `stage`; the yielded Timer's `elapsed` can go on log events."""
+    timer = Timer()
+    error = False
+    try:
+        yield timer
+    except BaseException:
+        error = True
+        raise
+    finally:
+        timer.end = time.perf_counter()
+        metrics.observe(stage, timer.end - timer.start, error)
+
+
+def timed_function(stage: str):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write_snapshot(path: str = METRICS_SNAPSHOT_PATH) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(metrics.snapshot(), f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = metrics.render_prometheus().encode(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(metrics.snapshot()).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> Optional[ThreadingHTTPServer]:
+    """Serve /metrics (Prometheus text) and /metrics.json from a daemon thread; port 0 disables it."""
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info('Metrics server started', host=host, port=port)
+    return server
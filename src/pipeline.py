@@ -0,0 +1,106 @@
+import queue
+import threading
+import structlog
+from typing import Callable, Iterable, List, Optional
+from src.metrics import timed
+
+logger = structlog.get_logger()
+
+_STOP = object()
+
+
+class Stage:
+    """One pipeline step: `workers` threads applying `func` to items from a bounded input queue.
+
+    `func` returns the item to hand to the next stage, or None to drop it. With
+    `batch_size` > 1 it receives a list of up to `batch_size` items, gathered until the
+    input goes quiet for `flush_interval` seconds, and returns a list of outputs.
+    """
+
+    def __init__(self, name: str, func: Callable, workers: int = 1, batch_size: int = 1, flush_interval: float = 1.0):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+
+class Pipeline:
+    """Runs stages as worker pools connected by bounded queues.
+
+    A full queue blocks the stage feeding it, so a slow stage applies backpressure all the
+    way back to the source instead of letting work pile up in memory. Items whose stage
+    raises are logged and dropped; `failed` counts them.
+    """
+
+    def __init__(self, stages: List[Stage], queue_size: int = 16):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.failed = 0
+        self.source_error: Optional[Exception] = None
+        self._lock = threading.Lock()
+
+    def _emit(self, index: int, output) -> None:
+        if output is None or index + 1 >= len(self.stages):
+            return
+        self.queues[index + 1].put(output)
+
+    def _next_batch(self, index: int, stage: Stage):
+        first = self.queues[index].get()
+        if first is _STOP or stage.batch_size <= 1:
+            return first, []
+        batch = [first]
+        while len(batch) < stage.batch_size:
+            try:
+                entry = self.queues[index].get(timeout=stage.flush_interval)
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                # Put it back so this worker stops after flushing the batch
+                self.queues[index].put(_STOP)
+                break
+            batch.append(entry)
+        return batch, batch
+
+    def _work(self, index: int, stage: Stage) -> None:
+        while True:
+            entry, batch = self._next_batch(index, stage)
+            if entry is _STOP:
+                return
+            try:
+                with timed(f"pipeline:{stage.name}"):
+                    outputs = stage.func(batch if stage.batch_size > 1 else entry)
+            except Exception as e:
+                with self._lock:
+                    self.failed += len(batch) if batch else 1
+                logger.error('Pipeline stage failed', stage=stage.name, error=str(e))
+                continue
+            for output in (outputs or []) if stage.batch_size > 1 else [outputs]:
+                self._emit(index, output)
+
+    def _feed(self, source: Iterable) -> None:
+        try:
+            for entry in source:
+                self.queues[0].put(entry)
+        except Exception as e:
+            self.source_error = e
+            logger.error('Pipeline source failed', error=str(e))
+
+    def run(self, source: Iterable) -> None:
+        """Push every item of `source` through all stages and wait for them to drain."""
+        feeder = threading.Thread(target=self._feed, args=(source,), name='pipeline-source', daemon=True)
+        feeder.start()
+        pools = []
+        for index, stage in enumerate(self.stages):
+            threads = [threading.Thread(target=self._work, args=(index, stage), name=f'pipeline-{stage.name}-{n}', daemon=True) for n in range(stage.workers)]
+            for thread in threads:
+                thread.start()
+            pools.append(threads)
+
+        feeder.join()
+        for index, threads in enumerate(pools):
+            for _ in threads:
+                self.queues[index].put(_STOP)
+            for thread in threads:
+                thread.join()
+        logger.info('Pipeline drained', stages=[stage.name for stage in self.stages], failed=self.failed)
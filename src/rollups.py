@@ -0,0 +1,111 @@
+import structlog
+from collections import defaultdict
+from typing import Dict, List, Tuple
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+from src.einvoice import Invoice
+from src.category_cache import normalize_name
+
+logger = structlog.get_logger()
+
+# Rollup collection -> the dimension it groups each month by
+ROLLUPS = {
+    "rollup_category": "category",
+    "rollup_seller": "seller",
+    "rollup_item": "item",
+}
+# OpenAI calls, tokens and cost spent on each month's invoices, per task. Only ever incremented:
+# it records spend as it happens, so unlike ROLLUPS it is never rebuilt from the invoices
+AI_ROLLUP = "rollup_ai"
+
+
+def ensure_indexes(database, invoice_collection) -> None:
+    """Compound indexes for the rollups and for date-range queries on the invoices themselves."""
+    for name, dimension in ROLLUPS.items():
+        database[name].create_index([("account", ASCENDING), (dimension, ASCENDING), ("month", ASCENDING)], unique=True)
+        database[name].create_index([("account", ASCENDING), ("month", ASCENDING), ("total", DESCENDING)])
+    database[AI_ROLLUP].create_index([("account", ASCENDING), ("task", ASCENDING), ("month", ASCENDING)], unique=True)
+    invoice_collection.create_index([("invoice_datetime", ASCENDING)])
+    invoice_collection.create_index([("seller_name", ASCENDING), ("invoice_datetime", ASCENDING)])
+    invoice_collection.create_index([("items.ai_category", ASCENDING), ("invoice_datetime", ASCENDING)])
+
+
+def _month(invoice: Invoice) -> str:
+    return invoice.invoice_datetime.strftime("%Y-%m")
+
+
+def _increments(invoices: List[Invoice]) -> Dict[str, Dict[Tuple[str, str], Dict[str, int]]]:
+    increments = {name: defaultdict(lambda: defaultdict(int)) for name in ROLLUPS}
+    for invoice in invoices:
+        month = _month(invoice)
+        seller = increments["rollup_seller"][(month, invoice.seller_name)]
+        seller["total"] += invoice.total_amount
+        seller["invoices"] += 1
+        for item in invoice.items:
+            category = increments["rollup_category"][(month, item.ai_category or "Uncategorized")]
+            category["total"] += item.total_price
+            category["items"] += 1
+            entry = increments["rollup_item"][(month, normalize_name(item.item_name))]
+            entry["total"] += item.total_price
+            entry["quantity"] += item.quantity
+            entry["items"] += 1
+    return increments
+
+
+def update_rollups(database, account: str, invoices: List[Invoice]) -> None:
+    """Add newly persisted invoices to the monthly rollups with one bulk $inc per rollup collection."""
+    if not invoices:
+        return
+    _update_invoice_rollups(database, account, invoices)
+    update_ai_rollup(database, account, invoices)
+    logger.info('Rollups updated', account=account, invoices=len(invoices))
+
+
+def _update_invoice_rollups(database, account: str, invoices: List[Invoice]) -> None:
+    for name, groups in _increments(invoices).items():
+        dimension = ROLLUPS[name]
+        operations = [
+            UpdateOne({"account": account, "month": month, dimension: key}, {"$inc": dict(values)}, upsert=True)
+            for (month, key), values in groups.items()
+        ]
+        if operations:
+            database[name].bulk_write(operations, ordered=False)
+
+
+def update_ai_rollup(database, account: str, invoices: List[Invoice]) -> None:
+    """Add the AI usage recorded on `invoices` (at persist time, i.e. categorization) to the AI rollup."""
+    groups = defaultdict(lambda: defaultdict(int))
+    for invoice in invoices:
+        for task, usage in invoice.ai_usage.items():
+            for key, value in usage.items():
+                groups[(_month(invoice), task)][key] += value
+    operations = [
+        UpdateOne({"account": account, "month": month, "task": task}, {"$inc": dict(values)}, upsert=True)
+        for (month, task), values in groups.items()
+    ]
+    if operations:
+        database[AI_ROLLUP].bulk_write(operations, ordered=False)
+
+
+def add_ai_usage(database, account: str, invoice: Invoice, task: str, usage: Dict[str, float]) -> None:
+    """Add AI usage spent on an invoice after it was persisted, e.g. its background description."""
+    if usage:
+        database[AI_ROLLUP].update_one({"account": account, "month": _month(invoice), "task": task}, {"$inc": usage}, upsert=True)
+
+
+def rebuild_rollups(database, account: str, invoice_collection, batch_size: int = 500) -> None:
+    """Recompute the ROLLUPS of `account` from scratch, e.g. after reprocessing changed categories.
+
+    The AI rollup is left alone: the invoices only hold the usage of their latest processing.
+    """
+    for name in ROLLUPS:
+        database[name].delete_many({"account": account})
+    batch = []
+    for doc in invoice_collection.find({}, {"_id": 0}).batch_size(batch_size):
+        batch.append(Invoice.from_dict(doc))
+        if len(batch) >= batch_size:
+            _update_invoice_rollups(database, account, batch)
+            batch = []
+    if batch:
+        _update_invoice_rollups(database, account, batch)
+    logger.info('Rollups rebuilt', account=account)
@@ -0,0 +1,125 @@
+import os
+import time
+import heapq
+import threading
+import structlog
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+ACCOUNT_WORKERS = int(os.getenv("EINVOICE_ACCOUNT_WORKERS", 2))
+MIN_POLL_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", 1800))
+MAX_POLL_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", 21600))
+# Most polls (each one a JWT request, often a login) one account may use per 24 hours
+POLL_BUDGET = int(os.getenv("POLL_BUDGET", 24))
+POLL_BACKOFF = 2.0
+ACTIVITY_HISTORY = timedelta(days=90)
+# Last month is re-synced once this long into a new month, for invoices that reached the portal late
+CATCH_UP_DELAY = timedelta(hours=8)
+
+logger = structlog.get_logger()
+
+
+def catch_up_time(now: datetime) -> datetime:
+    """When the month-end catch-up of the month before `now` is due."""
+    return now.replace(day=1, hour=0, minute=0, second=0, microsecond=0) + CATCH_UP_DELAY
+
+
+class PollPlan:
+    """Decides when one account is polled next; its state lives in the account's sync_state document.
+
+    The interval drops to MIN_POLL_INTERVAL after a poll that found new invoices and grows by
+    POLL_BACKOFF after every empty one. It is then shortened or stretched by how often invoices
+    were issued in that hour of the day over ACTIVITY_HISTORY, kept within POLL_BUDGET polls
+    per 24 hours, and cut short so the next month-end catch-up is not missed.
+    """
+
+    def __init__(self, sync_state, invoices, account: str):
+        self.sync_state = sync_state
+        self.invoices = invoices
+        self.account = account
+        state = sync_state.find_one({"_id": account}) or {}
+        self.interval = state.get("poll_interval", MIN_POLL_INTERVAL)
+        self.next_poll_at: datetime = state.get("next_poll_at") or datetime.now()
+        self.recent_polls: List[datetime] = state.get("recent_polls", [])
+
+    def activity(self, now: datetime) -> List[float]:
+        """Relative invoice activity per hour of the day, 1.0 being an average hour."""
+        counts = [1] * 24
+        for doc in self.invoices.find({"invoice_datetime": {"$gte": now - ACTIVITY_HISTORY}}, {"invoice_datetime": 1, "_id": 0}):
+            counts[doc["invoice_datetime"].hour] += 1
+        mean = sum(counts) / 24
+        return [count / mean for count in counts]
+
+    def after_poll(self, new_invoices: int, now: Optional[datetime] = None) -> datetime:
+        """Record a finished poll and return when the next one is due."""
+        now = now or datetime.now()
+        self.interval = MIN_POLL_INTERVAL if new_invoices else min(MAX_POLL_INTERVAL, self.interval * POLL_BACKOFF)
+        weight = self.activity(now)[(now + timedelta(seconds=self.interval)).hour]
+        # Square root so a single busy hour does not pin the account to MIN_POLL_INTERVAL
+        next_poll_at = now + timedelta(seconds=min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, self.interval / weight ** 0.5)))
+
+        self.recent_polls = [poll for poll in self.recent_polls if poll > now - timedelta(days=1)] + [now]
+        if len(self.recent_polls) >= POLL_BUDGET:
+            next_poll_at = max(next_poll_at, self.recent_polls[-POLL_BUDGET] + timedelta(days=1))
+
+        catch_up = catch_up_time(now)
+        if catch_up <= now:
+            catch_up = catch_up_time(now + relativedelta(months=1))
+        next_poll_at = min(next_poll_at, catch_up)
+
+        self.next_poll_at = next_poll_at
+        self.sync_state.update_one({"_id": self.account}, {"$set": {"poll_interval": self.interval, "next_poll_at": next_poll_at, "recent_polls": self.recent_polls}}, upsert=True)
+        logger.info('Next poll planned', account=self.account, new_invoices=new_invoices, interval=round(self.interval), activity=round(weight, 2), next_poll_at=next_poll_at)
+        return next_poll_at
+
+
+class AccountScheduler:
+    """Polls many accounts from one process with a bounded worker pool.
+
+    Each account is polled when its PollPlan says so, at most `workers` accounts at once and
+    never one account twice at once. `poll` returns how many new invoices it saved; a failed
+    poll is logged and counts as an empty one.
+    """
+
+    def __init__(self, poll: Callable[[str], int], plans: Dict[str, PollPlan], workers: int = ACCOUNT_WORKERS):
+        self.poll = poll
+        self.plans = plans
+        self.workers = workers
+        self.due = [(plan.next_poll_at.timestamp(), name) for name, plan in plans.items()]
+        heapq.heapify(self.due)
+        self.condition = threading.Condition()
+        self.stopped = False
+
+    def _poll(self, name: str) -> None:
+        new_invoices = 0
+        try:
+            new_invoices = self.poll(name)
+        except Exception as e:
+            logger.error('Account poll failed', account=name, error=str(e))
+        try:
+            next_poll_at = self.plans[name].after_poll(new_invoices)
+        except Exception as e:
+            logger.error('Failed to plan next poll', account=name, error=str(e))
+            next_poll_at = datetime.now() + timedelta(seconds=MAX_POLL_INTERVAL)
+        with self.condition:
+            heapq.heappush(self.due, (next_poll_at.timestamp(), name))
+            self.condition.notify()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self) -> None:
+        """Poll accounts as they fall due until `stop` is called, then wait for running polls."""
+        logger.info('Account scheduler started', accounts=list(self.plans), workers=self.workers)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='account') as executor:
+            with self.condition:
+                while not self.stopped:
+                    if self.due and self.due[0][0] <= time.time():
+                        _, name = heapq.heappop(self.due)
+                        executor.submit(self._poll, name)
+                    else:
+                        self.condition.wait(self.due[0][0] - time.time() if self.due else None)
@@ -0,0 +1,82 @@
+import os
+import json
+import time
+import structlog
+import requests
+from typing import Optional
+from src.metrics import metrics
+
+SESSION_PATH = os.getenv("EINVOICE_SESSION_PATH", "einvoice_session.json")
+SESSION_TTL = int(os.getenv("EINVOICE_SESSION_TTL", 12 * 60 * 60))
+
+logger = structlog.get_logger()
+
+# How often a cached session was reused vs. a fresh Chrome login was needed
+login_cache_stats = {'hit': 0, 'miss': 0}
+
+
+def account_session_path(account: str, path: str = SESSION_PATH) -> str:
+    """Per-account session file next to SESSION_PATH, e.g. einvoice_session.lambert.json."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{account}{ext}"
+
+
+def save_session(session: requests.Session, path: str = SESSION_PATH, ttl: int = SESSION_TTL) -> None:
+    data = {
+        'expires_at': time.time() + ttl,
+        'headers': dict(session.headers),
+        'cookies': [
+            {
+                'name': cookie.name,
+                'value': cookie.value,
+                'domain': cookie.domain,
+                'path': cookie.path,
+                'secure': cookie.secure,
+                'expires': cookie.expires,
+            } for cookie in session.cookies
+        ],
+    }
+    tmp_path = f"{path}.tmp"
+    # The file holds the portal's bearer token and cookies, so only the owner may read it
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # A .tmp left over from an older run keeps its mode through O_CREAT
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+    logger.info("Login session saved", path=path, ttl=ttl)
+
+
+def load_session(session: requests.Session, path: str = SESSION_PATH) -> Optional[requests.Session]:
+    """Restore cookies and headers from the session store into `session`.
+
+    Returns None (and counts a miss) when there is no stored session or it has expired.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        data = None
+
+    if data is None or data.get('expires_at', 0) <= time.time():
+        login_cache_stats['miss'] += 1
+        metrics.incr('login_cache', 'miss')
+        logger.info("Login session cache miss", **login_cache_stats)
+        return None
+
+    session.headers.update(data['headers'])
+    for cookie in data['cookies']:
+        session.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'], secure=cookie['secure'], expires=cookie['expires'])
+
+    login_cache_stats['hit'] += 1
+    metrics.incr('login_cache', 'hit')
+    logger.info("Login session cache hit", **login_cache_stats)
+    return session
+
+
+def clear_session(path: str = SESSION_PATH) -> None:
+    try:
+        os.remove(path)
+        logger.info("Login session cleared", path=path)
+    except FileNotFoundError:
+        pass
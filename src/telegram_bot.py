@@ -1,33 +1,259 @@
 import os
+import asyncio
+import threading
 import structlog
-from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
-from src.einvoice import Invoice
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Callable, List, Optional
+from src.einvoice import Invoice, DESCRIPTION_PENDING
+from src.metrics import metrics, timed
 
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_API", None)
 USER_ID = os.getenv("TELEGRAM_CHAT_ID", None)
+API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org/bot")
+# Seconds to gather a burst of invoices into one digest message, 0 sends every invoice on its own
+DIGEST_WINDOW = float(os.getenv("TELEGRAM_DIGEST_WINDOW", 0))
+DIGEST_MAX_INVOICES = 10
+MAX_MESSAGE_LENGTH = 4096
+# Telegram allows roughly one message per second in a single chat
+MIN_SEND_INTERVAL = 1.0
+# Longest wait between attempts to reach Telegram when the worker starts
+MAX_CONNECT_BACKOFF = 300
 
 logger = structlog.get_logger()
 
-async def send_invoice_msg(invoice: Invoice):
 
-    if not BOT_TOKEN or not USER_ID:
-        logger.warning('Telegram bot token or user ID is not set, message sender function will not proceed')
-        return
+def format_description(invoice: Invoice) -> str:
+    if invoice.description_status == DESCRIPTION_PENDING:
+        return "（AI 評論生成中…）"
+    return invoice.ai_description or ""
 
-    bot = Bot(BOT_TOKEN)
 
-    invoice_cashew_url = invoice.to_cashew_url()
+def format_invoice_msg(invoice: Invoice) -> str:
+    return f"你有新發票進來了哦～～～\n{format_description(invoice)}\n\n發票號碼: {invoice.invoice_number}\n賣家: {invoice.seller_name}\n總金額: {invoice.total_amount} 元\n開立時間: {invoice.invoice_datetime}\n\n詳細內容:\n" + "\n".join([f"- {item.item_name} x{item.quantity} @ {item.unit_price} 元 = {item.total_price} 元 ({item.ai_category})" for item in invoice.items])
 
-    logger.info('Sending invoice message to Telegram', invoice=invoice.invoice_number, url=invoice_cashew_url)
 
-    keyboard = [
-        [InlineKeyboardButton("新增到 Cashew", url=invoice_cashew_url)]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    text_msg = f"你有新發票進來了哦～～～\n{invoice.ai_description}\n\n發票號碼: {invoice.invoice_number}\n賣家: {invoice.seller_name}\n總金額: {invoice.total_amount} 元\n開立時間: {invoice.invoice_datetime}\n\n詳細內容:\n" + "\n".join([f"- {item.item_name} x{item.quantity} @ {item.unit_price} 元 = {item.total_price} 元 ({item.ai_category})" for item in invoice.items])
-    await bot.send_message(
-        chat_id=USER_ID,
-        text=text_msg,
-        reply_markup=reply_markup,
-        disable_web_page_preview=True,
-    )
\ No newline at end of file
+def format_digest_msg(invoices: List[Invoice]) -> str:
+    text_msg = f"你有 {len(invoices)} 張新發票進來了哦～～～\n\n" + "\n\n".join([f"🧾 {invoice.seller_name} {invoice.total_amount} 元 ({invoice.invoice_datetime})\n發票號碼: {invoice.invoice_number}\n{format_description(invoice)}" for invoice in invoices])
+    return text_msg[:MAX_MESSAGE_LENGTH]
+
+
+def format_message(invoices: List[Invoice]) -> str:
+    return format_invoice_msg(invoices[0]) if len(invoices) == 1 else format_digest_msg(invoices)
+
+
+def invoice_keyboard(invoices: List[Invoice]) -> 'InlineKeyboardMarkup':
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    if len(invoices) == 1:
+        keyboard = [[InlineKeyboardButton("新增到 Cashew", url=invoices[0].to_cashew_url())]]
+    else:
+        keyboard = [[InlineKeyboardButton(f"新增到 Cashew: {invoice.seller_name} {invoice.total_amount} 元", url=invoice.to_cashew_url())] for invoice in invoices]
+    return InlineKeyboardMarkup(keyboard)
+
+
+@dataclass(slots=True)
+class MessageEdit:
+    message_id: int
+    invoices: List[Invoice]
+
+
+class TelegramNotifier:
+    """Long-lived Telegram sender.
+
+    Invoices are queued with `enqueue` from any thread and sent by a background worker
+    that owns one `Bot` (and its HTTP connections) on its own event loop, so callers never
+    wait on Telegram. The worker starts with the first queued invoice unless `start` is
+    called earlier, so commands that never notify do not load python-telegram-bot.
+
+    `on_sent(invoices, message_id, text)` is called after each message goes out, and
+    `edit` re-renders a sent message, e.g. once an invoice's AI description is ready.
+    """
+
+    def __init__(self, token: Optional[str] = BOT_TOKEN, chat_id: Optional[str] = USER_ID, digest_window: float = DIGEST_WINDOW, max_retries: int = 5, on_sent: Optional[Callable[[List[Invoice], int, str], None]] = None):
+        self.token = token
+        self.chat_id = chat_id
+        self.digest_window = digest_window
+        self.max_retries = max_retries
+        self.on_sent = on_sent
+        self.enabled = bool(token and chat_id)
+        self.loop = asyncio.new_event_loop()
+        self.queue = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='telegram-notifier', daemon=True)
+        self._start_lock = threading.Lock()
+        self._closing = False
+        if not self.enabled:
+            logger.warning('Telegram bot token or user ID is not set, message sender function will not proceed')
+
+    def start(self) -> 'TelegramNotifier':
+        """Start the worker, or a fresh one on a new event loop if the previous worker has died."""
+        if not self.enabled:
+            return self
+        with self._start_lock:
+            if not self.thread.is_alive():
+                # Imported here, on the caller's thread: a first import of telegram/httpx on the
+                # worker thread races other threads (e.g. OpenAI calls) importing httpx
+                import telegram  # noqa: F401
+                if self.thread.ident is not None:
+                    logger.warning('Telegram notifier worker had stopped, restarting it')
+                    self.loop = asyncio.new_event_loop()
+                    self.ready = threading.Event()
+                    self.thread = threading.Thread(target=self._run, name='telegram-notifier', daemon=True)
+                self._closing = False
+                self.thread.start()
+        self.ready.wait()
+        return self
+
+    def _put(self, entry) -> None:
+        # Never raises: callers such as the persist stage must not fail because Telegram does
+        try:
+            self.start()
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, entry)
+        except Exception as e:
+            logger.error('Failed to queue Telegram message', error=str(e))
+
+    def enqueue(self, invoice: Invoice) -> None:
+        if not self.enabled:
+            return
+        self._put(invoice)
+
+    def edit(self, message_id: int, invoices: List[Invoice]) -> None:
+        if not self.enabled:
+            return
+        self._put(MessageEdit(message_id, invoices))
+
+    def close(self, timeout: float = 60) -> None:
+        """Flush queued messages and stop the worker."""
+        if not self.enabled or not self.thread.is_alive():
+            return
+        self._closing = True
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+        self.thread.join(timeout)
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.queue = asyncio.Queue()
+        self.ready.set()
+        self.loop.run_until_complete(self._worker())
+
+    async def _connect(self, bot: 'Bot') -> bool:
+        """Initialize `bot` (a getMe call), retrying with backoff until it succeeds or `close` is called."""
+        attempt = 0
+        while not self._closing:
+            try:
+                await bot.initialize()
+                return True
+            except Exception as e:
+                delay = min(2 ** attempt, MAX_CONNECT_BACKOFF)
+                attempt += 1
+                metrics.incr('retries', 'telegram_connect')
+                logger.warning('Failed to connect to Telegram, retrying', error=str(e), delay=delay, attempt=attempt, queued=self.queue.qsize())
+                await asyncio.sleep(delay)
+        return False
+
+    async def _worker(self) -> None:
+        """Drain the queue until `close`; a failure is logged and the worker carries on with the next entry."""
+        from telegram import Bot
+        bot = Bot(self.token, base_url=API_BASE)
+        if not await self._connect(bot):
+            logger.error('Telegram unreachable while closing, queued messages dropped', queued=self.queue.qsize())
+            return
+        try:
+            closing = False
+            while not closing:
+                try:
+                    closing = await self._process(bot)
+                except Exception as e:
+                    logger.error('Telegram notifier failed to process the queue, continuing', error=str(e))
+        finally:
+            try:
+                await bot.shutdown()
+            except Exception as e:
+                logger.warning('Failed to shut down the Telegram bot', error=str(e))
+
+    async def _process(self, bot: 'Bot') -> bool:
+        """Handle the next queue entry (and the digest it starts); returns True once `close` was requested."""
+        entry = await self.queue.get()
+        if entry is None:
+            return True
+        if isinstance(entry, MessageEdit):
+            await self._edit(bot, entry)
+            await asyncio.sleep(MIN_SEND_INTERVAL)
+            return False
+        closing = False
+        batch, edits = [entry], []
+        if self.digest_window > 0:
+            deadline = self.loop.time() + self.digest_window
+            while len(batch) < DIGEST_MAX_INVOICES:
+                try:
+                    entry = await asyncio.wait_for(self.queue.get(), max(0, deadline - self.loop.time()))
+                except asyncio.TimeoutError:
+                    break
+                if entry is None:
+                    closing = True
+                    break
+                if isinstance(entry, MessageEdit):
+                    edits.append(entry)
+                else:
+                    batch.append(entry)
+        await self._send(bot, batch)
+        await asyncio.sleep(MIN_SEND_INTERVAL)
+        for edit in edits:
+            await self._edit(bot, edit)
+            await asyncio.sleep(MIN_SEND_INTERVAL)
+        return closing
+
+    async def _call(self, stage: str, request: Callable, invoice_numbers: List[str]):
+        """Await `request()`, retrying rate limits and network errors; returns None when it fails."""
+        from telegram.error import BadRequest, RetryAfter, TimedOut, NetworkError
+        for attempt in range(self.max_retries):
+            try:
+                with timed(stage) as timer:
+                    result = await request()
+                logger.info('Telegram request done', stage=stage, invoices=invoice_numbers, duration=timer.elapsed)
+                return result
+            except RetryAfter as e:
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                metrics.incr('retries', stage)
+                logger.warning('Telegram rate limit hit, retrying', retry_after=delay, attempt=attempt + 1)
+                await asyncio.sleep(delay)
+            except BadRequest as e:
+                # Subclass of NetworkError, but retrying a rejected request (e.g. "message is not modified") cannot help
+                logger.error('Telegram rejected the request', stage=stage, invoices=invoice_numbers, error=str(e))
+                return None
+            except (TimedOut, NetworkError) as e:
+                delay = min(2 ** attempt, 60)
+                metrics.incr('retries', stage)
+                logger.warning('Telegram request failed, retrying', error=str(e), delay=delay, attempt=attempt + 1)
+                await asyncio.sleep(delay)
+            except Exception as e:
+                logger.error('Telegram request failed', stage=stage, invoices=invoice_numbers, error=str(e))
+                return None
+        logger.error('Giving up on Telegram request', stage=stage, invoices=invoice_numbers, attempts=self.max_retries)
+        return None
+
+    async def _send(self, bot: 'Bot', invoices: List[Invoice]) -> None:
+        text_msg = format_message(invoices)
+        invoice_numbers = [invoice.invoice_number for invoice in invoices]
+        logger.info('Sending invoice message to Telegram', invoices=invoice_numbers)
+        message = await self._call('telegram_send', lambda: bot.send_message(
+            chat_id=self.chat_id,
+            text=text_msg,
+            reply_markup=invoice_keyboard(invoices),
+            disable_web_page_preview=True,
+        ), invoice_numbers)
+        if message is None or self.on_sent is None:
+            return
+        try:
+            await self.loop.run_in_executor(None, self.on_sent, invoices, message.message_id, text_msg)
+        except Exception as e:
+            logger.error('Failed to record sent invoice message', invoices=invoice_numbers, error=str(e))
+
+    async def _edit(self, bot: 'Bot', edit: MessageEdit) -> None:
+        await self._call('telegram_edit', lambda: bot.edit_message_text(
+            chat_id=self.chat_id,
+            message_id=edit.message_id,
+            text=format_message(edit.invoices),
+            reply_markup=invoice_keyboard(edit.invoices),
+            disable_web_page_preview=True,
+        ), [invoice.invoice_number for invoice in edit.invoices])
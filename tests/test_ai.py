@@ -0,0 +1,53 @@
+import json
+import pytest
+import src.ai as ai
+
+
+class FakeCache:
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, item_name, seller=None):
+        return self.entries.get((item_name, seller))
+
+    def set(self, item_name, seller, category):
+        self.entries[(item_name, seller)] = category
+
+
+class FakeClassifier:
+    def predict(self, item_name, seller=None):
+        return 'Shopping', 0.1
+
+
+@pytest.mark.parametrize('reply, category', [
+    ('Dining', 'Dining'),
+    (' dining.\n', 'Dining'),
+    ('"Bills & Fees"', 'Bills & Fees'),
+    ('Category: Groceries', 'Groceries'),
+    ('Food', None),
+    ('Dining or Groceries', None),
+    ('', None),
+    (None, None),
+])
+def test_normalize_category(reply, category):
+    assert ai.normalize_category(reply) == category
+
+
+def test_batch_caches_only_listed_categories(monkeypatch):
+    monkeypatch.setattr(ai, 'OPENAI_ENABLED', True)
+    monkeypatch.setattr(ai, 'ai', lambda *args, **kwargs: json.dumps({'categories': ['groceries', 'Snacks']}))
+    cache = FakeCache()
+
+    result = ai.ai_categorize_batch([{'item': 'milk'}, {'item': 'chips'}], 'store', cache=cache, classifier=FakeClassifier())
+
+    assert result == [('Groceries', ai.CATEGORY_SOURCE_LLM), ('Shopping', ai.CATEGORY_SOURCE_CLASSIFIER)]
+    assert cache.entries == {('milk', 'store'): 'Groceries'}
+
+
+def test_single_item_unknown_reply_is_not_cached(monkeypatch):
+    monkeypatch.setattr(ai, 'OPENAI_ENABLED', True)
+    monkeypatch.setattr(ai, 'ai', lambda *args, **kwargs: 'I think this is a snack')
+    cache = FakeCache()
+
+    assert ai.ai_categorize('chips', 'store', cache=cache) == (None, None)
+    assert cache.entries == {}
@@ -0,0 +1,103 @@
+import threading
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+import pytest
+from manager import InvoiceManager, split_windows
+
+
+def test_month_windows_follow_calendar_months():
+    windows = split_windows(datetime(2024, 11, 15, 8, 30), datetime(2025, 2, 3, 12, 0))
+    assert windows == [
+        (datetime(2024, 11, 15, 8, 30), datetime(2024, 11, 30, 23, 59, 59, 999999)),
+        (datetime(2024, 12, 1), datetime(2024, 12, 31, 23, 59, 59, 999999)),
+        (datetime(2025, 1, 1), datetime(2025, 1, 31, 23, 59, 59, 999999)),
+        (datetime(2025, 2, 1), datetime(2025, 2, 3, 12, 0)),
+    ]
+
+
+def test_windows_cover_the_range_without_gaps():
+    start, end = datetime(2023, 1, 31, 23, 0), datetime(2024, 3, 1)
+    for granularity in ('month', 'week'):
+        windows = split_windows(start, end, granularity)
+        assert windows[0][0] == start
+        assert windows[-1][1] == end
+        for (_, previous_end), (next_start, _) in zip(windows, windows[1:]):
+            assert next_start - previous_end == timedelta(microseconds=1)
+
+
+def test_week_windows_are_seven_days_from_midnight():
+    windows = split_windows(datetime(2024, 1, 1, 10, 0), datetime(2024, 1, 20), 'week')
+    assert windows == [
+        (datetime(2024, 1, 1, 10, 0), datetime(2024, 1, 7, 23, 59, 59, 999999)),
+        (datetime(2024, 1, 8), datetime(2024, 1, 14, 23, 59, 59, 999999)),
+        (datetime(2024, 1, 15), datetime(2024, 1, 20)),
+    ]
+
+
+def test_range_within_one_month_is_a_single_window():
+    start, end = datetime(2024, 2, 10), datetime(2024, 2, 29, 23, 59)
+    assert split_windows(start, end) == [(start, end)]
+
+
+def test_empty_range_has_no_windows():
+    assert split_windows(datetime(2024, 3, 2), datetime(2024, 3, 1)) == []
+
+
+def test_unknown_granularity_is_rejected():
+    with pytest.raises(ValueError):
+        split_windows(datetime(2024, 1, 1), datetime(2024, 2, 1), 'day')
+
+
+class FakeCheckpoints:
+    def __init__(self):
+        self.docs = {}
+        self.lock = threading.Lock()
+
+    def find_one(self, query):
+        return self.docs.get(query["_id"])
+
+    def update_one(self, query, update, upsert=False):
+        with self.lock:
+            self.docs.setdefault(query["_id"], {"_id": query["_id"]}).update(update["$set"])
+
+
+def make_manager(fail_windows=(), error_windows=()):
+    """An InvoiceManager with only what backfill touches; sync_window records the windows it is asked for."""
+    manager = InvoiceManager.__new__(InvoiceManager)
+    manager.account = SimpleNamespace(name="acct")
+    manager.backfill_checkpoints = FakeCheckpoints()
+    manager.get_session = lambda: "session"
+    manager.synced = []
+
+    def sync_window(start_time, end_time, session=None):
+        assert session == "session"
+        manager.synced.append(start_time)
+        if start_time in error_windows:
+            raise RuntimeError("portal down")
+        return end_time, start_time not in fail_windows, 0
+
+    manager.sync_window = sync_window
+    return manager
+
+
+START, END = datetime(2024, 1, 1), datetime(2024, 3, 31, 23, 59, 59, 999999)
+MONTHS = [datetime(2024, 1, 1), datetime(2024, 2, 1), datetime(2024, 3, 1)]
+
+
+def test_backfill_syncs_every_window_and_checkpoints_it():
+    manager = make_manager()
+    assert manager.backfill(START, END, workers=3) is True
+    assert sorted(manager.synced) == MONTHS
+    assert [doc["status"] for doc in manager.backfill_checkpoints.docs.values()] == ["done"] * 3
+
+
+def test_rerun_only_retries_unfinished_windows():
+    manager = make_manager(fail_windows={MONTHS[1]}, error_windows={MONTHS[2]})
+    assert manager.backfill(START, END) is False
+    assert sorted(doc["status"] for doc in manager.backfill_checkpoints.docs.values()) == ["done", "failed", "failed"]
+
+    checkpoints = manager.backfill_checkpoints
+    manager = make_manager()
+    manager.backfill_checkpoints = checkpoints
+    assert manager.backfill(START, END) is True
+    assert sorted(manager.synced) == MONTHS[1:]
@@ -0,0 +1,45 @@
+import pytest
+from src.einvoice import InvoiceItem, parse_amount, parse_number
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('1,280', 1280),
+    (' 35 ', 35),
+    ('0.345', 0.345),
+    ('29.9', 29.9),
+    ('2.0', 2),
+    (3, 3),
+    (1.5, 1.5),
+    ('', 0),
+    (None, 0),
+])
+def test_parse_number(value, expected):
+    number = parse_number(value)
+    assert number == expected
+    assert type(number) is type(expected)
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('1,280', 1280),
+    ('0', 0),
+    ('99.6', 100),
+    (120.4, 120),
+    (75, 75),
+    ('', 0),
+    (None, 0),
+])
+def test_parse_amount_rounds_to_whole_dollars(value, expected):
+    amount = parse_amount(value)
+    assert amount == expected
+    assert type(amount) is int
+
+
+def test_parse_number_rejects_garbage():
+    with pytest.raises(ValueError):
+        parse_number('N/A')
+
+
+def test_item_from_legacy_string_document_keeps_fractional_quantity():
+    item = InvoiceItem.from_dict({'ai_category': 'Groceries', 'item_name': 'bananas', 'quantity': '0.345', 'unit_price': '29.9', 'total_price': '10'})
+    assert (item.quantity, item.unit_price, item.total_price) == (0.345, 29.9, 10)
+    assert item.category_source is None
@@ -0,0 +1,69 @@
+import json
+import urllib.parse
+from datetime import datetime
+from src.einvoice import Invoice, InvoiceItem, CASHEW_BASE_URL
+from src.export import iter_cashew_url_batches
+
+
+def make_invoice(number: str, items: int, name: str = 'item') -> Invoice:
+    return Invoice(
+        invoice_number=number,
+        total_amount=10 * items,
+        seller_name='全家便利商店',
+        invoice_datetime=datetime(2024, 5, 1, 12, 0),
+        ai_description=None,
+        items=[InvoiceItem(ai_category='Dining', item_name=f"{name} {i}", quantity=1, unit_price=10, total_price=10) for i in range(items)],
+    )
+
+
+def decode(url: str) -> list:
+    assert url.startswith(f"{CASHEW_BASE_URL}?JSON=")
+    payload = urllib.parse.unquote(urllib.parse.unquote(url.split('?JSON=', 1)[1]))
+    return json.loads(payload)['transactions']
+
+
+def test_everything_fits_in_one_url():
+    invoices = [make_invoice('AB00000001', 2), make_invoice('AB00000002', 3)]
+    urls = list(iter_cashew_url_batches(invoices))
+    assert len(urls) == 1
+    assert [t['title'] for t in decode(urls[0])] == ['item 0', 'item 1', 'item 0', 'item 1', 'item 2']
+
+
+def test_batches_respect_the_limit_and_keep_every_transaction_in_order():
+    invoices = [make_invoice(f"AB{n:08d}", 4, name='珍珠奶茶') for n in range(10)]
+    one = next(iter_cashew_url_batches([make_invoice('AB00000000', 1, name='珍珠奶茶')]))
+    max_length = 3 * len(one)
+
+    urls = list(iter_cashew_url_batches(invoices, max_length))
+
+    assert len(urls) > 1
+    assert all(len(url) <= max_length for url in urls)
+    transactions = [t for url in urls for t in decode(url)]
+    assert [(t['notes'], t['title']) for t in transactions] == [(t['notes'], t['title']) for invoice in invoices for t in invoice.to_cashew_transactions()]
+
+
+def test_batches_are_packed_greedily():
+    invoices = [make_invoice('AB00000001', 6)]
+    single = len(next(iter_cashew_url_batches([make_invoice('AB00000001', 1)])))
+    pair = len(next(iter_cashew_url_batches([make_invoice('AB00000001', 2)])))
+
+    urls = list(iter_cashew_url_batches(invoices, pair))
+
+    # Exactly two transactions fit at this limit, and each URL's length is predicted exactly
+    assert [len(decode(url)) for url in urls] == [2, 2, 2]
+    assert all(len(url) == pair for url in urls)
+    assert single < pair
+
+
+def test_transaction_longer_than_the_limit_is_skipped():
+    long_invoice = make_invoice('AB00000001', 1, name='x' * 500)
+    short_invoice = make_invoice('AB00000002', 1)
+    limit = len(next(iter_cashew_url_batches([short_invoice])))
+
+    urls = list(iter_cashew_url_batches([long_invoice, short_invoice], limit))
+
+    assert [[t['title'] for t in decode(url)] for url in urls] == [['item 0']]
+
+
+def test_no_invoices_yields_no_urls():
+    assert list(iter_cashew_url_batches([])) == []
@@ -0,0 +1,121 @@
+import threading
+from src.pipeline import Pipeline, Stage
+
+
+def _pipeline_threads():
+    return [thread for thread in threading.enumerate() if thread.name.startswith('pipeline-')]
+
+
+def test_run_passes_every_item_through_all_stages():
+    results = []
+    lock = threading.Lock()
+
+    def collect(item):
+        with lock:
+            results.append(item)
+
+    pipeline = Pipeline([
+        Stage('double', lambda item: item * 2, workers=4),
+        Stage('increment', lambda item: item + 1, workers=2),
+        Stage('collect', collect),
+    ], queue_size=2)
+    pipeline.run(range(100))
+
+    assert sorted(results) == [item * 2 + 1 for item in range(100)]
+    assert pipeline.failed == 0
+    assert pipeline.source_error is None
+
+
+def test_run_stops_every_worker_thread():
+    pipeline = Pipeline([Stage('a', lambda item: item, workers=3), Stage('b', lambda items: items, workers=2, batch_size=5, flush_interval=0.01)])
+    pipeline.run(range(20))
+    assert _pipeline_threads() == []
+
+
+def test_none_drops_the_item():
+    results = []
+    pipeline = Pipeline([
+        Stage('odd', lambda item: item if item % 2 else None),
+        Stage('collect', results.append),
+    ])
+    pipeline.run(range(10))
+    assert sorted(results) == [1, 3, 5, 7, 9]
+
+
+def test_batch_stage_receives_lists_up_to_batch_size():
+    batches = []
+    lock = threading.Lock()
+
+    def persist(items):
+        with lock:
+            batches.append(list(items))
+        return items
+
+    pipeline = Pipeline([Stage('persist', persist, batch_size=4, flush_interval=0.05)], queue_size=8)
+    pipeline.run(range(10))
+
+    assert all(1 <= len(batch) <= 4 for batch in batches)
+    assert sorted(item for batch in batches for item in batch) == list(range(10))
+
+
+def test_batch_outputs_are_emitted_one_by_one():
+    results = []
+    pipeline = Pipeline([
+        Stage('batch', lambda items: [item * 10 for item in items], batch_size=3, flush_interval=0.01),
+        Stage('collect', results.append),
+    ])
+    pipeline.run(range(7))
+    assert sorted(results) == [item * 10 for item in range(7)]
+
+
+def test_failing_items_are_counted_and_the_rest_continue():
+    results = []
+
+    def fragile(item):
+        if item % 3 == 0:
+            raise ValueError(f"bad item {item}")
+        return item
+
+    pipeline = Pipeline([Stage('fragile', fragile, workers=2), Stage('collect', results.append)])
+    pipeline.run(range(9))
+
+    assert pipeline.failed == 3
+    assert sorted(results) == [1, 2, 4, 5, 7, 8]
+
+
+def test_failing_batch_counts_every_item_in_it():
+    def fail(items):
+        raise RuntimeError("database down")
+
+    pipeline = Pipeline([Stage('persist', fail, batch_size=10, flush_interval=0.05)], queue_size=16)
+    pipeline.run(range(6))
+    assert pipeline.failed == 6
+
+
+def test_source_error_is_recorded_and_the_pipeline_still_drains():
+    results = []
+
+    def source():
+        yield 1
+        yield 2
+        raise ConnectionError("listing failed")
+
+    pipeline = Pipeline([Stage('collect', results.append)])
+    pipeline.run(source())
+
+    assert sorted(results) == [1, 2]
+    assert isinstance(pipeline.source_error, ConnectionError)
+    assert _pipeline_threads() == []
+
+
+def test_slow_stage_applies_backpressure_without_deadlock():
+    seen = []
+    release = threading.Event()
+
+    def slow(item):
+        release.wait(0.001)
+        seen.append(item)
+
+    pipeline = Pipeline([Stage('fast', lambda item: item, workers=4), Stage('slow', slow)], queue_size=1)
+    pipeline.run(range(50))
+    assert sorted(seen) == list(range(50))
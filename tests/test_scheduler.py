@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+from src.scheduler import PollPlan, MIN_POLL_INTERVAL, MAX_POLL_INTERVAL, POLL_BACKOFF, POLL_BUDGET
+
+
+class FakeSyncState:
+    def __init__(self, docs=None):
+        self.docs = docs or {}
+
+    def find_one(self, query):
+        return self.docs.get(query["_id"])
+
+    def update_one(self, query, update, upsert=False):
+        self.docs.setdefault(query["_id"], {"_id": query["_id"]}).update(update["$set"])
+
+
+class FakeInvoices:
+    def __init__(self, datetimes=()):
+        self.datetimes = list(datetimes)
+
+    def find(self, query, projection=None):
+        since = query["invoice_datetime"]["$gte"]
+        return [{"invoice_datetime": value} for value in self.datetimes if value >= since]
+
+
+def make_plan(invoices=(), **state):
+    sync_state = FakeSyncState({"acct": {"_id": "acct", **state}} if state else None)
+    return PollPlan(sync_state, FakeInvoices(invoices), "acct"), sync_state
+
+
+# Mid-month, far from the month-end catch-up
+NOW = datetime(2024, 5, 15, 10, 0)
+
+
+def test_interval_resets_after_new_invoices_and_backs_off_when_empty():
+    plan, _ = make_plan(poll_interval=MIN_POLL_INTERVAL * 4)
+    assert plan.after_poll(3, NOW) == NOW + timedelta(seconds=MIN_POLL_INTERVAL)
+
+    plan, _ = make_plan()
+    assert plan.after_poll(0, NOW) == NOW + timedelta(seconds=MIN_POLL_INTERVAL * POLL_BACKOFF)
+
+    plan, _ = make_plan(poll_interval=MAX_POLL_INTERVAL)
+    assert plan.after_poll(0, NOW) == NOW + timedelta(seconds=MAX_POLL_INTERVAL)
+
+
+def test_busy_hour_shortens_the_wait_within_bounds():
+    interval = MIN_POLL_INTERVAL * 4
+    busy = [(NOW + timedelta(seconds=interval * POLL_BACKOFF)).replace(minute=0) - timedelta(days=day) for day in range(1, 60)]
+    plan, _ = make_plan(busy, poll_interval=interval)
+
+    next_poll_at = plan.after_poll(0, NOW)
+
+    assert NOW + timedelta(seconds=MIN_POLL_INTERVAL) <= next_poll_at < NOW + timedelta(seconds=interval * POLL_BACKOFF)
+
+
+def test_poll_budget_pushes_the_next_poll_a_day_past_the_oldest_counted_poll():
+    oldest = NOW - timedelta(hours=20)
+    recent = [oldest + timedelta(minutes=i) for i in range(POLL_BUDGET - 1)]
+    plan, sync_state = make_plan(poll_interval=MIN_POLL_INTERVAL, recent_polls=[NOW - timedelta(days=2)] + recent)
+
+    next_poll_at = plan.after_poll(5, NOW)
+
+    assert next_poll_at == oldest + timedelta(days=1)
+    # Polls older than a day no longer count against the budget
+    assert sync_state.docs["acct"]["recent_polls"] == recent + [NOW]
+
+
+def test_under_budget_polls_are_not_delayed():
+    recent = [NOW - timedelta(hours=20) + timedelta(minutes=i) for i in range(POLL_BUDGET - 2)]
+    plan, _ = make_plan(recent_polls=recent)
+    assert plan.after_poll(5, NOW) == NOW + timedelta(seconds=MIN_POLL_INTERVAL)
+
+
+def test_next_poll_is_capped_at_the_month_end_catch_up():
+    now = datetime(2024, 6, 1, 5, 0)
+    plan, _ = make_plan(poll_interval=MAX_POLL_INTERVAL)
+    assert plan.after_poll(0, now) == datetime(2024, 6, 1, 8, 0)
+
+
+def test_catch_up_cap_moves_to_next_month_once_passed():
+    now = datetime(2024, 6, 1, 9, 0)
+    plan, _ = make_plan(poll_interval=MAX_POLL_INTERVAL)
+    assert plan.after_poll(0, now) == now + timedelta(seconds=MAX_POLL_INTERVAL)
+
+
+def test_state_is_persisted_for_the_next_plan():
+    plan, sync_state = make_plan()
+    next_poll_at = plan.after_poll(0, NOW)
+
+    reloaded = PollPlan(sync_state, FakeInvoices(), "acct")
+
+    assert reloaded.interval == MIN_POLL_INTERVAL * POLL_BACKOFF
+    assert reloaded.next_poll_at == next_poll_at
+    assert reloaded.recent_polls == [NOW]
@@ -0,0 +1,15 @@
+from dotenv import load_dotenv
+load_dotenv()
+
+import os
+import pymongo
+from src.ai import category_list
+from src.classifier import train_classifier
+from src.accounts import load_accounts
+
+MONGO_DB_URL = os.getenv('MONGO_DB_URL', None)
+
+client = pymongo.MongoClient(f"mongodb://{MONGO_DB_URL}")
+
+# One classifier serves every account, so it learns from all of their invoices
+train_classifier([client["invoice"][account.name] for account in load_accounts()], category_list)